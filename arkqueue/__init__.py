@@ -1 +1 @@
-__all__ = ["arkqueue", "arkvp", "tod"]
\ No newline at end of file
+__all__ = ["arkqueue", "arkvp", "arkreactor", "callbacks", "dedup", "editdistance", "geo", "metrics", "monitors", "prefixtable", "resultsink", "tod", "todsim", "tracebatch", "transport"]
\ No newline at end of file
@@ -5,6 +5,10 @@
 # Description:  General class for holding useful Ark stuff, with advanced options and functionality
 
 import struct
+import collections
+import heapq
+import gzip
+import bz2
 import socket
 import random
 import subprocess
@@ -17,21 +21,53 @@ import logging
 import numpy as np
 from threading import Thread
 from threading import Event
+from threading import Lock
 
 #import tod
 from counter import Counter
+from arkstats import ArkStats
 from arkvp import ArkVP
+from journal import Journal
+from callbacks import CallbackExecutor
+from spillqueue import SpillQueue
+from metrics import Metrics, MetricsServer
+from monitors import MonitorRegistry
+from geo import MonitorLocator
 
 
 class ArkQueue(Thread):
-    def __init__(self, useBad=False, monitorfile=None, sessionid=None, yaml=True, verbose=False, submit_hook=None, finish_hook=None, idle_hook=None, concurrency=25, timeout=600, monitor_blacklist=None, window_max=10080, loggingLevel=logging.INFO):
+    vp_class = ArkVP
+    
+    def __init__(self, useBad=False, monitorfile=None, sessionid=None, yaml=True, verbose=False, submit_hook=None, finish_hook=None, idle_hook=None, concurrency=25, timeout=600, monitor_blacklist=None, window_max=10080, loggingLevel=logging.INFO, journal=None, resume=False, sink=None, executor=None, finish_batch_hook=None, batch_size=1000, batch_latency=1.0, adaptive=False, max_concurrency=None, max_in_flight=None, select_policy='p2c', dedup=None, high_water=100000, spill_dir=None, spill_items=100000, vp_spill_items=10000, metrics_port=None, locate=None, geo_k=3, family_mismatch='reject', transport=None, deadline=None, max_attempts=3, retry_backoff=5.0, retry_policy='other', expire_hook=None):
         Thread.__init__(self)
         self.verbose = verbose
         self.sessionid = sessionid
         self.concurrency = concurrency
+        self.adaptive = adaptive            # per-VP AIMD in-flight limit, starting at concurrency
+        self.max_concurrency = max_concurrency
+        self.transport = transport              # makes each VP's link to ToD; None runs ./tod-client
+        self.select_policy = select_policy      # how addProbe picks a VP for bare targets: 'p2c', 'lect' or 'geo'
+        self.locate = locate                    # 'geo': target -> (latitude, longitude) or None
+        self.geo_k = geo_k                      # 'geo': the least loaded of this many nearest monitors
+        self.family_mismatch = family_mismatch  # "vp target" the VP can't probe: 'reject', 'reroute' or None to send anyway
+        self.families = collections.defaultdict(int)    # targets by address family, and misrouting avoided
         self.timeout = timeout
+        self.deadline = deadline                # seconds each request may stay outstanding at ToD; None waits forever
+        self.max_attempts = max_attempts        # tries per target, counting the first, before it is given up on
+        self.retry_backoff = retry_backoff      # before retry n, wait retry_backoff * 2**(n-1) s
+        self.retry_policy = retry_policy        # retry on the 'same' VP while it still responds, or an equivalent 'other' one
+        self.expire_hook = expire_hook          # called with ([vp, target], attempt, retry VP or None); once per requester given up on
+        self.attempts = dict()                  # (vp, target) being retried -> its attempt number
+        self.retrying = []                      # heap of (due, priority, vp, target) waiting out their backoff
+        self.retryLock = Lock()
+        self.expiry = collections.defaultdict(int)
         self.submit_hook = submit_hook
         self.finish_hook = finish_hook
+        self.finish_batch_hook = finish_batch_hook     # called with lists of (out, [vp, target])
+        self.batch_size = batch_size
+        self.batch_latency = batch_latency              # longest a finished probe waits for its batch to fill
+        self.batch = list()
+        self.batch_deadline = 0
         self.idle_hook = idle_hook
         self.useBadMonitors = useBad
         self.max_rtt_hist = window_max
@@ -52,7 +88,13 @@ class ArkQueue(Thread):
         # add ch to logger
         self.logger.addHandler(ch)
         
-        self.targets = Queue.PriorityQueue()
+        # with a spill_dir, targets beyond spill_items (vp_spill_items per VP) wait on disk
+        self.spill_dir = spill_dir
+        self.vp_spill_items = vp_spill_items
+        if spill_dir:
+            self.targets = SpillQueue(memory_items=spill_items, spill_dir=spill_dir)
+        else:
+            self.targets = Queue.PriorityQueue()
         self.results = Queue.PriorityQueue()
         self.vpsUsed = 0
         self.monitor_flag = False
@@ -64,20 +106,71 @@ class ArkQueue(Thread):
         self.team = dict()
         self.vps = dict()
         self.probenum = Counter(0)
+        self.counters = ArkStats()      # aggregate counters kept up to date by each ArkVP
+        self.monitor_list_changes = -1
+        self.counters.cap = max_in_flight
+        self.counters.resume_hook = self.wake_vps
         self.maxtimeouts = 10
         self.requests_outstanding = dict()
+        self.queued = collections.defaultdict(int)  # targets per VP still in self.targets
+        self.queuedLock = Lock()
+        self.high_water = high_water    # most targets held in ArkQueue and VP queues before addProbe input is left unread
+        self.feeding = 0                # background threads still reading addProbe input
+        self.feedLock = Lock()
         self.callbacks_t = Thread(target=self.callback_thread, args=(self.results,))
         self.callbacks_t.daemon = True
         
+        # collapse duplicate (vp, target) requests and reuse recent results
+        self.dedup = dedup
+        
+        # journal every target so an interrupted campaign can be resumed
+        self.journal = None
+        if journal:
+            self.journal = Journal(journal, resume=resume, loggingLevel=loggingLevel)
+            self.probenum = Counter(self.journal.maxreqid)  # late results for old reqids are then ignored
+            for target in self.journal.pending:
+                if self.dedup and self.dedup.request(target[1], target[2])[0] != 'probe':
+                    continue
+                self.targets.put(target + [time.time()])
+                self.queued[target[1]] += 1
+        
+        # hooks run (and are timed) on the executor; by default inline in the callback thread
+        if executor is None:
+            executor = CallbackExecutor(workers=0, loggingLevel=loggingLevel)
+        self.executor = executor
+        
+        # latency histograms and counters, optionally served as Prometheus text on localhost
+        self.metrics = Metrics()
+        self.metrics.addCollector(self.collect_metrics)
+        self.executor.metrics = self.metrics
+        self.metrics_server = None
+        if metrics_port is not None:
+            self.metrics_server = MetricsServer(self.metrics, port=metrics_port, loggingLevel=loggingLevel)
+            self.metrics_server.start()
+        
+        # finished traces also go to the result sink, which holds back new probes when it falls behind
+        self.sink = sink
+        if self.sink:
+            self.sink.resume_hook = self.wake_vps
+            if not self.sink.is_alive():
+                self.sink.start()
+        
         if monitor_blacklist:
             self.blacklist = blacklist
         else:
             self.blacklist = ['nap-it', 'sea-us', 'nce-fr', 'bed-us', 'muc-de', 'ord-us', 'sin2-sg', 'nrt2-jp', 'gig-br', 'dkr-sn', 'mry-us']
         # process a CAIDA monitors.yaml file
+        self.registry = None    # every monitors.yaml field, when read from one
+        self.capable = None     # {'v4': monitors, 'v6': monitors} able to probe each family, when known
         if monitorfile and yaml:
           self.readMonitorsYaml(monitorfile)
         if monitorfile and not yaml:
           self.readMonitorsTxt(monitorfile)
+        self.locator = MonitorLocator(self.registry) if self.registry else None
+        if self.registry:
+            self.capable = {'v4': set(mon.name for mon in self.registry if mon.ip),
+                            'v6': set(mon.name for mon in self.registry if mon.ip6 or 'topo_v6' in mon.capabilities)}
+            self.capable_mask = dict((family, self.locator.mask(names)) for (family, names) in self.capable.iteritems())
         for team in self.team:
           self.logger.debug("Updating with " + str(len(self.team[team])) + " team " + str(team) + " monitors")
           self.logger.debug(str(self.team[team]))
@@ -93,8 +186,10 @@ class ArkQueue(Thread):
         #self.last_monitor = len(self.monitor_list) - 1
     
     def update_monitor_list(self, useBad=False):
+        self.monitor_list_changes = self.counters.changes
         down_monitors = self.blacklist + self.vps_not_responding_list()
-        temp_monitors = self.monitors
+        # self.monitors stays the full set, so VPs that respond again come back
+        temp_monitors = dict(self.monitors)
         if not useBad:
             for down in down_monitors:
                 if down in temp_monitors:
@@ -102,6 +197,10 @@ class ArkQueue(Thread):
         self.monitors_by_ip = dict((v,k) for k, v in temp_monitors.iteritems())
         self.monitor_list = temp_monitors.keys()
         self.last_monitor = len(self.monitor_list) - 1
+        if self.locator:
+            self.locator.setAvailable(self.monitor_list)
+        if self.capable:
+            self.family_lists = dict((family, [vp for vp in self.monitor_list if vp in names]) for (family, names) in self.capable.iteritems())
     
     #def signal_handler(self, signal, frame):
     #    self.exit()
@@ -121,7 +220,16 @@ class ArkQueue(Thread):
         self.logger.info("Waiting for callbacks to finish.")
         self.callbacks_t.join()
         #self.results.join()
+        self.executor.close()
         self.logger.info("Callbacks finished.")
+        if self.sink:
+            self.sink.close()
+        if self.journal:
+            self.journal.close()
+        if isinstance(self.targets, SpillQueue):
+            self.targets.close()
+        if self.metrics_server:
+            self.metrics_server.stop()
     
     def readMonitorsTxt(self, monitorfile):
       f = open(monitorfile, 'r')  
@@ -131,24 +239,13 @@ class ArkQueue(Thread):
         self.team[1][mon] = ip
 
     def readMonitorsYaml(self, monitorfile):
-      f = open(monitorfile, 'r')
-      (mon, ip, team) = (None, None, None)
-      for line in f:
-        fields = line.strip().split()
-        if len(fields) == 2:
-          if fields[0] == '.monitor:':
-            (mon, ip, team) = (None, None, None)
-            mon = fields[1]
-          if fields[0] == 'ip_address:':
-            ip = fields[1]
-          if fields[0] == 'team:': 
-            team = fields[1]
-          if not( (mon is None) or (ip is None) ):
-            self.logger.debug("Monitor: "+ str(mon) +", IP: "+ str(ip) +", Team:"+ str(team))
-            if (team not in self.team):
-              self.team[team] = dict()
-            self.team[team][mon] = ip
-            (mon, ip, team) = (None, None, None)
+      self.registry = MonitorRegistry(monitorfile, loggingLevel=self.logging_level)
+      for mon in self.registry:
+        if mon.enabled and mon.ip:
+          self.logger.debug("Monitor: "+ str(mon.name) +", IP: "+ str(mon.ip) +", Team:"+ str(mon.team))
+          if (mon.team not in self.team):
+            self.team[mon.team] = dict()
+          self.team[mon.team][mon.name] = mon.ip
 
     def numMonitors(self):
         return len(self.monitor_list)
@@ -172,7 +269,57 @@ class ArkQueue(Thread):
     def getMonitorByIP(self, ip):
         return self.monitors_by_ip[ip]
 
-    def get(self, rand=False):
+    def expectedCompletion(self, vp, default_rtt=1.0):
+        "(estimated s until a new probe from vp would finish, probes ahead of it)"
+        depth = self.queued.get(vp, 0)
+        (limit, rtt) = (self.concurrency, default_rtt)
+        if vp in self.vps:
+            arkvp = self.vps[vp]
+            depth += arkvp.getWaiting() + arkvp.getOutstanding()
+            limit = arkvp.getLimit()
+            if len(arkvp.RTTs) > 0:
+                rtt = arkvp.getRTT(window=limit)
+        return ((depth // limit + 1) * rtt, depth)
+
+    @staticmethod
+    def addressFamily(trg):
+        return 'v6' if ':' in trg else 'v4'
+
+    def getFamilyMonitors(self, family=None):
+        "usable monitors able to probe this address family ('v4' or 'v6'); all of them if unknown"
+        if family and self.capable:
+            return self.family_lists[family]
+        return self.monitor_list
+
+    def canProbe(self, vp, family):
+        return not self.capable or vp not in self.registry or vp in self.capable[family]
+
+    def getNearestMonitors(self, latitude, longitude, k=1, family=None):
+        "the k usable monitors closest to a coordinate, closest first (needs a monitors.yaml)"
+        if not self.locator:
+            return []
+        mask = self.capable_mask[family] if family and self.capable else None
+        return [vp for (vp, km) in self.locator.nearest(latitude, longitude, k, mask)]
+
+    def getBestMonitor(self, policy='p2c', default_rtt=None, location=None, family=None):
+        "least loaded monitor: the better of two random ones (p2c), of all of them (lect), or of the geo_k nearest to location (geo)"
+        if default_rtt is None:
+            default_rtt = self.counters.percentiles((50,))[0] or 1.0   # for monitors with no history yet
+        monitors = self.getFamilyMonitors(family)
+        if not monitors:
+            return None
+        candidates = None
+        if policy == 'geo' and location:
+            candidates = self.getNearestMonitors(location[0], location[1], self.geo_k, family)
+        if not candidates and policy == 'lect':
+            candidates = monitors
+        elif not candidates:
+            candidates = random.sample(monitors, min(2, len(monitors)))
+        return min(candidates, key=lambda vp: self.expectedCompletion(vp, default_rtt))
+
+    def get(self, rand=False, policy=None):
+        if policy:
+            return self.getBestMonitor(policy)
         if rand:
             return self.getRandMonitor()
         else:
@@ -196,91 +343,59 @@ class ArkQueue(Thread):
         netaddr = ArkMonitor.numToDottedQuad(n)
         return netaddr
     
+    def stats(self):
+        "consistent snapshot of the aggregate probe and vantage point counters"
+        snapshot = self.counters.snapshot()
+        snapshot['targets_queued'] = self.targets.qsize()
+        return snapshot
+    
     def probes_submitted(self):
-        probes_submitted = 0
-        for vp in self.vps.keys():
-            probes_submitted += self.vps[vp].getTotal()
-        return probes_submitted
+        return self.counters.submitted
     
     def probes_waiting(self):
-        probes_waiting = 0
-        for vp in self.vps.keys():
-            probes_waiting += self.vps[vp].getWaiting()
-        return probes_waiting
+        return self.counters.waiting
     
     def probes_active(self):
-        probes_active = 0
-        for vp in self.vps.keys():
-            probes_active += self.vps[vp].getOutstanding()
-        return probes_active
+        return self.counters.outstanding
         
     def probes_complete(self):
-        probes_complete = 0
-        for vp in self.vps.keys():
-            probes_complete += self.vps[vp].getComplete()
-        return probes_complete
+        return self.counters.complete
+
+    def probes_expired(self):
+        return self.counters.expired
 
     def targets_remaining(self):
-        targets_remaining = 0
-        for vp in self.vps.keys():
-            targets_remaining += self.vps[vp].getIncomplete()
-        return targets_remaining
+        return self.counters.remaining()
     
     def vps_alive(self):
-        vps_alive = 0
-        for vp in self.vps.keys():
-            if self.vps[vp].is_alive():
-                vps_alive += 1
-        return vps_alive
+        return len(self.counters.members) - len(self.counters.stopped)
 
     def vps_active(self):
-        vps_active = 0
-        for vp in self.vps.keys():
-            if self.vps[vp].isActive():
-                vps_active += 1
-        return vps_active
+        self.counters.expire()
+        return len(self.counters.active)
     
     def vps_responding(self):
-        vps_resp = 0
-        for vp in self.vps.keys():
-            if self.vps[vp].isResponding():
-                vps_resp += 1
-        return vps_resp
+        self.counters.expire()
+        return len(self.counters.responding)
     
     def vps_responding_list(self):
-        vps_resp = list()
-        for vp in self.vps.keys():
-            if self.vps[vp].isResponding():
-                vps_resp.append(vp)
-        return vps_resp
+        self.counters.expire()
+        return list(self.counters.responding)
     
     def vps_not_responding(self):
-        vps_stopped = 0
-        for vp in self.vps.keys():
-            if not self.vps[vp].isResponding():
-                vps_stopped += 1
-        return vps_stopped
+        self.counters.expire()
+        return len(self.counters.members) - len(self.counters.responding)
     
     def vps_not_responding_list(self):
-        vps_stopped = list()
-        for vp in self.vps.keys():
-            if not self.vps[vp].isResponding():
-                vps_stopped.append(vp)
-        return vps_stopped
+        self.counters.expire()
+        with self.counters.lock:
+            return [vp for vp in self.counters.members if vp not in self.counters.responding]
     
     def vps_stopped(self):
-        vps_stopped = 0
-        for vp in self.vps.keys():
-            if not self.vps[vp].is_alive():
-                vps_stopped += 1
-        return vps_stopped
+        return len(self.counters.stopped)
     
     def vps_stopped_list(self):
-        vps_stopped = list()
-        for vp in self.vps.keys():
-            if not self.vps[vp].is_alive():
-                vps_stopped.append(vp)
-        return vps_stopped
+        return list(self.counters.stopped)
     
     def vps_rtt_dict(self, window=1):
         vps_rtt = dict()
@@ -297,6 +412,57 @@ class ArkQueue(Thread):
     
     def avg_rtt(self, window=1):
         return np.mean(self.vps_rtt_dict(window=window).values())
+    
+    def rtt_percentiles(self, qs=(50, 95, 99)):
+        return self.counters.percentiles(qs)
+    
+    def vps_rtt_percentiles(self, qs=(50, 95, 99)):
+        return dict((vp, self.vps[vp].getRTTPercentiles(qs)) for vp in self.vps.keys())
+        
+    def collect_metrics(self):
+        "gauges and totals read at snapshot time, as (name, type, labels, value)"
+        samples = list()
+        for (name, value) in self.stats().iteritems():
+            kind = 'counter' if name in ('probes_submitted', 'probes_complete', 'probes_expired') else 'gauge'
+            samples.append(('arkqueue_' + name + ('_total' if kind == 'counter' else ''), kind, {}, value))
+        for vp in self.vps.keys():
+            arkvp = self.vps[vp]
+            samples.append(('arkqueue_vp_waiting', 'gauge', {'vp': vp}, arkvp.getWaiting()))
+            samples.append(('arkqueue_vp_outstanding', 'gauge', {'vp': vp}, arkvp.getOutstanding()))
+            samples.append(('arkqueue_vp_limit', 'gauge', {'vp': vp}, arkvp.getLimit()))
+            samples.append(('arkqueue_vp_responding', 'gauge', {'vp': vp}, int(arkvp.stateResponding)))
+        samples.append(('arkqueue_retries_total', 'counter', {}, self.expiry['retried']))
+        samples.append(('arkqueue_abandoned_total', 'counter', {}, self.expiry['abandoned']))
+        samples.append(('arkqueue_retries_waiting', 'gauge', {}, len(self.retrying)))
+        for family in ('v4', 'v6'):
+            samples.append(('arkqueue_targets_total', 'counter', {'family': family}, self.families[family]))
+            samples.append(('arkqueue_targets_rerouted_total', 'counter', {'family': family}, self.families[family + '_rerouted']))
+            samples.append(('arkqueue_targets_rejected_total', 'counter', {'family': family}, self.families[family + '_rejected']))
+        for (hook, stats) in self.callback_stats().iteritems():
+            samples.append(('arkqueue_callback_errors_total', 'counter', {'hook': hook}, stats['errors']))
+        if self.sink:
+            samples.append(('arkqueue_sink_queued', 'gauge', {}, self.sink.queue.qsize()))
+        return samples
+    
+    def metrics_snapshot(self):
+        "{metric name: samples}; see Metrics.snapshot"
+        return self.metrics.snapshot()
+    
+    def vps_limit_dict(self):
+        return dict((vp, self.vps[vp].getLimit()) for vp in self.vps.keys())
+    
+    def family_stats(self):
+        "targets queued per address family, and how many were rerouted or rejected to avoid a VP unable to probe them"
+        return dict((name, self.families[name]) for name in ('v4', 'v6', 'v4_rerouted', 'v6_rerouted', 'v4_rejected', 'v6_rejected'))
+    
+    def expiry_stats(self):
+        "requests that passed their deadline, how many were retried and how many given up on"
+        return {'expired': self.expiry['expired'], 'retried': self.expiry['retried'], 'abandoned': self.expiry['abandoned'],
+                'retries_waiting': len(self.retrying)}
+    
+    def callback_stats(self):
+        "{hook name: call count, errors, mean queue wait and mean/max/p50/p95/p99 run time in s}"
+        return self.executor.stats()
         
     def clear_tod(self, vp=None, clear_responding=False):
         if vp and vp in self.vps.keys():
@@ -321,9 +487,15 @@ class ArkQueue(Thread):
         sys.stdout.flush()
     
     def print_status(self):
-        print "Probes active:", self.probes_active(), "Probes complete:", self.probes_complete(), "Probes waiting:", self.probes_waiting()
-        print "Vantage points active:", self.vps_active(), "Vantage points stopped:", self.vps_stopped()
+        stats = self.stats()
+        print "Probes active:", stats['probes_active'], "Probes complete:", stats['probes_complete'], "Probes waiting:", stats['probes_waiting']
+        print "Vantage points active:", stats['vps_active'], "Vantage points stopped:", stats['vps_stopped']
         print "Vantage points stopped:", self.vps_stopped_list()
+        limits = self.vps_limit_dict()
+        if limits:
+            print "Concurrency limit total:", sum(limits.values()), "Global cap:", self.counters.cap, "Per VP min/max:", str(min(limits.values())) + "/" + str(max(limits.values()))
+        if self.adaptive:
+            print "Concurrency limits:", limits
     
     def print_vp_summary(self):
         for vp in self.vps.keys():
@@ -334,13 +506,29 @@ class ArkQueue(Thread):
         print "Total number of probes submitted:", self.probes_submitted()
         print "Number of probes completed:", self.probes_complete()
         print "Average probe completion time:", self.avg_rtt(window=self.max_rtt_hist), "s"
+        print "Probe completion time p50/p95/p99:", "/".join(["%.1f" % rtt for rtt in self.rtt_percentiles()]), "s"
         print "Number of probes not completed:", self.targets_remaining()
+        if self.probes_expired():
+            print "Number of probes expired:", self.probes_expired()
+        if self.dedup:
+            stats = self.dedup.stats()
+            print "Requests answered from cache:", stats['cache_hits'], "Duplicate requests collapsed:", stats['duplicates_collapsed']
+        if self.deadline:
+            expiry = self.expiry_stats()
+            print "Requests expired after " + str(self.deadline) + " s:", expiry['expired'], "retried:", expiry['retried'], "given up:", expiry['abandoned']
+        families = self.family_stats()
+        if families['v6_rerouted'] or families['v6_rejected'] or families['v4_rerouted'] or families['v4_rejected']:
+            print "IPv4/IPv6 targets:", str(families['v4']) + "/" + str(families['v6']), "rerouted:", families['v4_rerouted'] + families['v6_rerouted'], "rejected:", families['v4_rejected'] + families['v6_rejected']
+        for (hook, stats) in sorted(self.callback_stats().items()):
+            print "Average " + hook + " time:", stats['mean'], "s", "p95:", stats['p95'], "s", "errors:", stats['errors']
         print "Number of Ark vantage points used:", self.vpsUsed
         print "Number of Ark vantage points not responding:", self.vps_not_responding()
         print "List of Ark vantage points not responding:", self.vps_not_responding_list()
     
     def is_active(self):
-        return ((not self.targets.empty()) or (self.probes_waiting() > 0) or (self.probes_active() > 0)) and (self.vps_active() > 0)
+        stats = self.stats()
+        retries = self.retrying or stats['probes_expired'] > self.expiry['expired']   # expired requests may yet be retried
+        return (stats['targets_queued'] > 0 or stats['probes_waiting'] > 0 or stats['probes_active'] > 0 or self.feeding > 0 or retries) and stats['vps_active'] > 0
     
     def is_responding(self):
         return self.vps_responding() > 0
@@ -355,43 +543,300 @@ class ArkQueue(Thread):
     def monitor_stop(self):
         self.monitor_flag = False
         
+    @staticmethod
+    def targetLines(targets):
+        "the non-blank, non-comment lines of a target list, any iterable of them, or a (.gz/.bz2) file of them, read lazily"
+        if not isinstance(targets, basestring):
+            for line in targets:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    yield line
+            return
+        if targets.endswith('.gz'):
+            f = gzip.open(targets, 'rb')
+        elif targets.endswith('.bz2'):
+            f = bz2.BZ2File(targets, 'rb')
+        else:
+            f = open(targets, 'r')
+        try:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    yield line
+        finally:
+            f.close()
+    
+    def queue_depth(self):
+        return self.targets.qsize() + self.counters.waiting
+    
+    # Targets are "vp target", or just "target" to let select_policy pick the vantage point.
+    # With select_policy='geo', "target latitude longitude" supplies the target's location;
+    # otherwise it comes from locate(target), and targets with neither go to a p2c choice.
+    # Bare targets only go to monitors able to probe their address family (per monitors.yaml);
+    # "vp target" pairs the VP can't probe are handled as family_mismatch says.
+    # Up to high_water of them are queued before returning; the rest are read by a
+    # background thread as the queues drain, so input of any size takes bounded memory.
     def addProbe(self, targets, priority=3):
-        while len(targets) > 0:
-            [vp, trg] = targets.pop(0).split()
-            self.targets.put([priority, vp, trg])
+        lines = self.targetLines(targets)
+        if not self.queue_targets(lines, priority, block=False):
+            with self.feedLock:
+                self.feeding += 1
+            feeder = Thread(target=self.feed_thread, args=(lines, priority))
+            feeder.daemon = True
+            feeder.start()
+    
+    def feed_thread(self, lines, priority):
+        try:
+            self.queue_targets(lines, priority, block=True)
+        except Exception as ex:
+            self.logger.error("Reading targets failed: " + str(ex))
+        finally:
+            with self.feedLock:
+                self.feeding -= 1
+    
+    def queue_targets(self, lines, priority, block):
+        "queue targets from lines; False if it stopped at high_water with input left"
+        default_rtt = self.counters.percentiles((50,))[0] or 1.0
+        for line in lines:
+            fields = line.split()
+            location = None
+            try:
+                if len(fields) == 3:
+                    location = (float(fields[1]), float(fields[2]))
+                elif len(fields) not in (1, 2):
+                    raise ValueError("expected 'target', 'vp target' or 'target latitude longitude'")
+            except ValueError as ex:
+                self.logger.warning("Skipping target line " + repr(line) + ": " + str(ex))
+                continue
+            trg = fields[0] if len(fields) != 2 else fields[1]
+            family = self.addressFamily(trg)
+            with self.queuedLock:
+                self.families[family] += 1
+            if len(fields) == 1:
+                if self.select_policy == 'geo' and self.locate:
+                    location = self.locate(trg)
+                vp = self.getBestMonitor(self.select_policy, default_rtt, location, family)
+            elif len(fields) == 3:
+                vp = self.getBestMonitor(self.select_policy, default_rtt, location, family)
+            else:
+                vp = fields[0]
+                if self.family_mismatch and not self.canProbe(vp, family):
+                    if self.family_mismatch == 'reroute':
+                        vp = self.getBestMonitor(self.select_policy, default_rtt, None, family)
+                        with self.queuedLock:
+                            self.families[family + '_rerouted'] += vp is not None
+                    else:
+                        vp = None
+            if vp is None:
+                with self.queuedLock:
+                    self.families[family + '_rejected'] += 1
+                self.logger.debug("No monitor can probe " + trg + ": " + line.strip())
+                continue
+            if self.dedup:
+                (action, out) = self.dedup.request(vp, trg)
+                if action == 'cached':
+                    self.results.put([4, [(out, [vp, trg])]])
+                if action != 'probe':
+                    continue
+            with self.queuedLock:
+                self.queued[vp] += 1
+            self.targets.put([priority, vp, trg, time.time()])
+            if self.journal:
+                self.journal.queued(priority, vp, trg)
+            if self.high_water and self.queue_depth() >= self.high_water:
+                self.targets_queued()
+                if not block:
+                    return False
+                while self.queue_depth() >= self.high_water and not self.exitEvent.isSet():
+                    self.exitEvent.wait(0.1)
+                if self.exitEvent.isSet():
+                    return True
+                default_rtt = self.counters.percentiles((50,))[0] or 1.0
+        self.targets_queued()
+        return True
+    
+    def targets_queued(self):
+        "called by queue_targets after each batch it adds to self.targets; run() already waits on the queue"
+        pass
+    
+    def dispatch_target(self, priority, vp, trg, queued=None):
+        if vp not in self.vps.keys():
+            self.start_vp(vp)
+        self.vps[vp].addProbe(trg, priority, queued)
+        with self.queuedLock:
+            self.queued[vp] -= 1
+        self.targets.task_done()
+    
+    def getRetryMonitor(self, vp, trg):
+        "where to retry a request that expired on vp, or None if there is nowhere"
+        if self.retry_policy == 'same' and vp in self.vps and self.vps[vp].stateResponding:
+            return vp
+        candidates = [mon for mon in self.getFamilyMonitors(self.addressFamily(trg)) if mon != vp]
+        mon = self.registry.get(vp) if self.registry else None
+        if self.locator and mon and mon.latitude is not None and mon.longitude is not None:
+            # monitors near the one that failed see much the same paths
+            nearby = [near for near in self.getNearestMonitors(mon.latitude, mon.longitude, self.geo_k + 1, self.addressFamily(trg)) if near != vp]
+            candidates = nearby or candidates
+        elif len(candidates) > 2:
+            candidates = random.sample(candidates, 2)
+        if not candidates:
+            return None
+        default_rtt = self.counters.percentiles((50,))[0] or 1.0
+        return min(candidates, key=lambda mon: self.expectedCompletion(mon, default_rtt))
+    
+    # Runs in the callback thread, as do deliver() and so every other use of self.attempts
+    def expire_requests(self, expired):
+        for (vp, trg, reqid, priority) in expired:
+            attempt = self.attempts.pop((vp, trg), 1)
+            retry = None
+            if attempt < self.max_attempts:
+                retry = self.getRetryMonitor(vp, trg)
+            if self.journal:
+                self.journal.expired(reqid, vp, trg)
+            requesters = 1
+            if retry:
+                self.attempts[(retry, trg)] = attempt + 1
+                if self.journal:
+                    self.journal.queued(priority, retry, trg)
+                if self.dedup and retry != vp:
+                    self.dedup.move(vp, trg, retry)
+                with self.retryLock:
+                    heapq.heappush(self.retrying, (time.time() + self.retry_backoff * 2 ** (attempt - 1), priority, retry, trg))
+                self.expiry['retried'] += 1
+            else:
+                if self.dedup:
+                    requesters += self.dedup.abandon(vp, trg)     # duplicates that waited on it are given up on too
+                self.expiry['abandoned'] += requesters
+                self.logger.debug("Giving up on " + vp + " " + trg + " after " + str(attempt) + " attempts")
+            self.expiry['expired'] += 1
+            if self.expire_hook:
+                for i in range(requesters):
+                    self.executor.submit('expire_hook', self.expire_hook, ([vp, trg], attempt, retry), key=vp)
+    
+    def release_retries(self):
+        "queue the retries whose backoff is over"
+        now = time.time()
+        due = list()
+        with self.retryLock:
+            while self.retrying and self.retrying[0][0] <= now:
+                due.append(heapq.heappop(self.retrying))
+        for (when, priority, vp, trg) in due:
+            with self.queuedLock:
+                self.queued[vp] += 1
+            self.targets.put([priority, vp, trg, now])
+    
+    def journal_finished(self, results):
+        for (out, request) in results:
+            self.journal.finished(int(out.split(None, 1)[0]), request[0], request[1])
+    
+    # Hand finish_batch_hook everything collected so far, at most batch_size at a time
+    def flush_batch(self):
+        (results, self.batch) = (self.batch, list())
+        for start in range(0, len(results), self.batch_size):
+            batch = results[start:start+self.batch_size]
+            done = None
+            if self.journal and not self.finish_hook:
+                done = lambda batch=batch: self.journal_finished([(out, request) for (out, request, journaled) in batch if journaled])
+            self.executor.submit('finish_batch_hook', self.finish_batch_hook, ([(out, request) for (out, request, journaled) in batch],), done=done)
+    
+    # Pass finished probes to the hooks; journaled results get their F record once delivered
+    def deliver(self, results, journaled=True):
+        journaled = journaled and self.journal
+        if self.attempts:
+            for (out, request) in results:
+                self.attempts.pop((request[0], request[1]), None)
+        for (out, request) in results:
+            #print 'Output =', out, 'Request =', request
+            if self.finish_hook:
+                done = None
+                if journaled:
+                    done = lambda result=(out, request): self.journal_finished([result])
+                self.executor.submit('finish_hook', self.finish_hook, (out, request), key=request[0], done=done)
+        if self.finish_batch_hook:
+            if not self.batch:
+                self.batch_deadline = time.time() + self.batch_latency
+            self.batch.extend([(out, request, journaled) for (out, request) in results])
+        elif journaled and not self.finish_hook:
+            self.journal_finished(results)
     
     def callback_thread(self, q):
         while not self.exitEvent.isSet():
+            timeout = 10
+            if self.batch:
+                # a batch is open, wake up in time to close it by its deadline
+                timeout = max(self.batch_deadline - time.time(), 0)
             try:
-                [priority, data] = q.get(timeout=10)
+                [priority, data] = q.get(timeout=timeout)
             except Queue.Empty:
                 pass
             else:
                 #print 'Result received, priority =', priority
-                if priority == 2:               # probe request submitted to tod
-                    [vp, trg] = data
-                    #print 'VP =', vp, 'Target =', trg
+                if priority == 2:               # probe requests submitted to tod
                     if self.submit_hook:
-                        self.submit_hook([vp, trg])
+                        for [vp, trg] in data:
+                            #print 'VP =', vp, 'Target =', trg
+                            self.executor.submit('submit_hook', self.submit_hook, ([vp, trg],), key=vp)
+                
+                elif priority == 3:             # probe requests finished, as (out, [vp, target])
+                    if self.sink:
+                        for (out, request) in data:
+                            self.sink.put(out, request)
+                    if self.dedup:
+                        # duplicates that waited on these requests get the same result;
+                        # a re-probe's requesters may already have had the other one's
+                        (results, duplicates, surplus) = (list(), list(), list())
+                        for (out, request) in data:
+                            waiting = self.dedup.complete(request[0], request[1], out)
+                            if waiting < 0:
+                                surplus.append((out, request))
+                            else:
+                                results.append((out, request))
+                                duplicates.extend([(out, request)] * waiting)
+                        self.deliver(results)
+                        self.deliver(duplicates, journaled=False)
+                        for (out, request) in surplus:
+                            self.attempts.pop((request[0], request[1]), None)
+                        if self.journal:
+                            self.journal_finished(surplus)
+                    else:
+                        self.deliver(data)
                 
-                elif priority == 3:             # probe request finished
-                    [out, request] = data
-                    #print 'Output =', out, 'Request =', request
-                    if self.finish_hook:
-                        self.finish_hook(out, request)
+                elif priority == 4:             # requests answered from the result cache
+                    self.deliver(data, journaled=False)
+                
+                elif priority == 5:             # requests past their deadline, as (vp, target, reqid, priority)
+                    self.expire_requests(data)
                 q.task_done()
+            if self.batch and (len(self.batch) >= self.batch_size or time.time() >= self.batch_deadline):
+                self.flush_batch()
+        if self.batch:
+            self.flush_batch()
     
     # Emulate arkmonitor.py API and behavior
     def probe(self, submit_hook, finish_hook, targets, idle_hook=None, traces_in_flight=None, timeout=None):
         self.submit_hook = submit_hook
         self.finish_hook = finish_hook
-        vpSet = set([i.split()[0] for i in targets])
         if idle_hook:
             self.idle_hook = idle_hook
-        if traces_in_flight:
-            self.concurrency = traces_in_flight // len(vpSet)
+        if traces_in_flight and isinstance(targets, (list, tuple)):
+            # only "vp target" lines name their VP; the others may go to any monitor
+            (vpSet, anyVP) = (set(), False)
+            for fields in (line.split() for line in self.targetLines(targets)):
+                if len(fields) == 2:
+                    vpSet.add(fields[0])
+                else:
+                    anyVP = True
+            if anyVP:
+                vpSet.update(self.getMonitors())
+            self.concurrency = traces_in_flight // max(len(vpSet), 1)
             if self.concurrency < 1:
                 self.concurrency = 1
+            if self.adaptive:
+                self.counters.cap = traces_in_flight    # VPs may grow past their share, but not the total
+        elif traces_in_flight:
+            # streamed targets can't be scanned for their VPs up front; cap the total instead
+            self.concurrency = traces_in_flight
+            self.counters.cap = traces_in_flight
         if timeout:
             self.timeout = timeout
         
@@ -407,25 +852,37 @@ class ArkQueue(Thread):
         print '------------'
         self.print_summary()
     
+    def start_vp(self, vp):
+        self.vps[vp] = self.vp_class(vpName=vp,sessionIdBase=self.sessionid,counter=self.probenum,result_queue=self.results,concurrency=self.concurrency,timeout=self.timeout,window_max=self.max_rtt_hist,loggingLevel=self.logging_level,stats=self.counters,journal=self.journal,gate=self.sink.gate if self.sink else None,adaptive=self.adaptive,max_concurrency=self.max_concurrency,spill_dir=self.spill_dir,spill_items=self.vp_spill_items,metrics=self.metrics,transport=self.transport,deadline=self.deadline)
+        self.vps[vp].daemon = True    # thread dies with the program
+        if self.journal and self.journal.outstanding.pop(vp, None):
+            # requests the resumed run left at ToD would only use up this session's concurrency
+            self.logger.info("Clearing requests left outstanding at ToD for " + vp + " by the journaled run.")
+            self.vps[vp].clearTod()
+        self.vps[vp].start()
+        self.vpsUsed += 1
+        return self.vps[vp]
+    
+    def wake_vps(self):
+        for vp in self.vps.keys():
+            self.vps[vp].wakeEvent.set()
+    
     def run(self):
         #callbacks_t = Thread(target=callback_thread, args=(self.results,))
         self.callbacks_t.start()
         while not self.exitEvent.isSet():
             try:
-                [priority, vp, trg] = self.targets.get(timeout=10)
+                [priority, vp, trg, queued] = self.targets.get(timeout=1 if self.deadline else 10)
             except Queue.Empty:
                 pass
             else:
-                if vp not in self.vps.keys():
-                    self.vps[vp] = ArkVP(vpName=vp,sessionIdBase=self.sessionid,counter=self.probenum,result_queue=self.results,concurrency=self.concurrency,timeout=self.timeout,window_max=self.max_rtt_hist,loggingLevel=self.logging_level)
-                    self.vps[vp].daemon = True    # thread dies with the program
-                    self.vps[vp].start()
-                    self.vpsUsed += 1
-            
-                self.vps[vp].addProbe(trg, priority)
-                self.targets.task_done()
+                self.dispatch_target(priority, vp, trg, queued)
             
-            self.update_monitor_list()
+            if self.retrying:
+                self.release_retries()
+            self.counters.expire()
+            if self.counters.changes != self.monitor_list_changes:
+                self.update_monitor_list()
             
             if self.idle_hook:
                 self.idle_hook()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+#
+# Program:      $Id$
+# Description:  Single-threaded engine that drives every vantage point's tod-client from one poll loop
+
+import os
+import fcntl
+import errno
+import select
+import Queue
+
+from arkqueue import ArkQueue
+from arkvp import ArkVP
+
+
+class ReactorVP(ArkVP):
+    """ArkVP that owns no threads; ArkReactor feeds it I/O events."""
+    def __init__(self, *args, **kwargs):
+        ArkVP.__init__(self, *args, **kwargs)
+        self.running = False
+        fd = self.fileno()
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def fileno(self):
+        return self.todClient.fileno()
+
+    def start(self):
+        self.running = True
+
+    def is_alive(self):
+        return self.running
+
+    def join(self, timeout=None):
+        pass
+
+    def onReadable(self):
+        # Read whatever is available; a partial line waits in the buffer for the next event
+        try:
+            data = os.read(self.fileno(), 65536)
+        except OSError as ex:
+            if ex.errno in (errno.EAGAIN, errno.EINTR):
+                return True
+            raise
+        if not data:
+            self.logger.error("tod-client closed its output.")
+            return False
+        self.receiveData(data)
+        self.sendProbes()
+        return True
+
+    def stop(self):
+        if self.running:
+            self.logger.debug("Stopping.")
+            self.running = False
+            self.clearWaiting()
+            self.todClient.close()
+            self.clearTod()
+            self.stats.vpStopped(self.vpName)
+
+    def exit(self):
+        ArkVP.exit(self)
+        self.stop()
+
+
+class ArkReactor(ArkQueue):
+    """ArkQueue that multiplexes all tod-client pipes in its own thread
+    instead of running two threads per vantage point."""
+    vp_class = ReactorVP
+
+    def __init__(self, *args, **kwargs):
+        ArkQueue.__init__(self, *args, **kwargs)
+        self.poller = select.poll()
+        self.fds = dict()
+        (self.wake_r, self.wake_w) = os.pipe()
+        for fd in (self.wake_r, self.wake_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.poller.register(self.wake_r, select.POLLIN)
+        self.resend = False
+
+    def wake(self):
+        try:
+            os.write(self.wake_w, 'x')
+        except OSError as ex:
+            if ex.errno != errno.EAGAIN:     # A full pipe means a wakeup is already pending
+                raise
+
+    # Called from the sink's thread; the sends happen in ours
+    def wake_vps(self):
+        self.resend = True
+        self.wake()
+
+    # Targets may be queued by addProbe's feed thread long after addProbe returns
+    def targets_queued(self):
+        self.wake()
+
+    def start_vp(self, vp):
+        arkvp = ArkQueue.start_vp(self, vp)
+        self.fds[arkvp.fileno()] = arkvp
+        self.poller.register(arkvp.fileno(), select.POLLIN)
+        return arkvp
+
+    def drop_vp(self, fd):
+        self.poller.unregister(fd)
+        self.fds.pop(fd).stop()
+
+    def dispatch(self):
+        touched = set()
+        while True:
+            try:
+                [priority, vp, trg, queued] = self.targets.get_nowait()
+            except Queue.Empty:
+                break
+            self.dispatch_target(priority, vp, trg, queued)
+            touched.add(vp)
+        for vp in touched:
+            if self.vps[vp].is_alive():
+                self.vps[vp].sendProbes()
+
+    def run(self):
+        self.callbacks_t.start()
+        while not self.exitEvent.isSet():
+            try:
+                events = self.poller.poll(1000)
+            except select.error as ex:
+                if ex[0] == errno.EINTR:
+                    continue
+                raise
+            for (fd, event) in events:
+                if fd == self.wake_r:
+                    try:
+                        os.read(self.wake_r, 4096)
+                    except OSError:
+                        pass
+                elif fd in self.fds:
+                    # one VP's failure must not take down the loop every VP shares
+                    try:
+                        alive = self.fds[fd].onReadable()
+                    except Exception:
+                        self.logger.exception("Stopping " + self.fds[fd].vpName + " after an error handling its tod-client output.")
+                        alive = False
+                    if not alive:
+                        try:
+                            self.drop_vp(fd)
+                        except Exception:
+                            self.logger.exception("Error stopping a VP.")
+            if self.deadline:
+                for arkvp in self.fds.values():
+                    if arkvp.expireRequests():
+                        arkvp.sendProbes()
+            if self.retrying:
+                self.release_retries()
+            self.dispatch()
+            if self.resend:
+                self.resend = False
+                for vp in self.vps.keys():
+                    if self.vps[vp].is_alive():
+                        self.vps[vp].sendProbes()
+
+            self.counters.expire()
+            if self.counters.changes != self.monitor_list_changes:
+                self.update_monitor_list()
+
+            if self.idle_hook:
+                self.idle_hook()
+
+        self.stop()
+        os.close(self.wake_r)
+        os.close(self.wake_w)
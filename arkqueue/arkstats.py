@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+#
+# Program:      $Id$
+# Description:  Thread-safe aggregate probe and vantage point counters shared by ArkQueue and its ArkVPs
+
+import time
+import heapq
+import threading
+
+from rtthistory import RTTSketch
+
+
+class ArkStats(object):
+    # ArkVPs report every queue, send, completion and state change here, so
+    # totals are read in O(1) instead of by polling every VP. Activity is
+    # time based, so each active VP also has one deadline (last activity +
+    # timeout) in a heap; expire() re-checks only VPs whose deadline passed.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.waiting = 0
+        self.outstanding = 0
+        self.complete = 0
+        self.expired = 0
+        self.members = dict()
+        self.active = set()
+        self.responding = set()
+        self.stopped = set()
+        self.changes = 0        # bumped whenever a VP changes state
+        self.deadlines = []
+        self.sketch = RTTSketch()   # completion times across all VPs
+        self.cap = None             # most probes allowed in flight across all VPs
+        self.capped = False         # a VP was turned away by the cap since it last had room
+        self.resume_hook = None     # called once the cap has room again
+
+    def count(self, submitted=0, waiting=0, outstanding=0, complete=0, rtt=None, expired=0):
+        with self.lock:
+            self.submitted += submitted
+            self.waiting += waiting
+            self.outstanding += outstanding
+            self.complete += complete
+            self.expired += expired
+            if rtt is not None:
+                self.sketch.add(rtt)
+            resume = self.capped and self.outstanding < self.cap
+            if resume:
+                self.capped = False
+        if resume and self.resume_hook:
+            self.resume_hook()
+    
+    def remaining(self):
+        "requests submitted to a VP that have neither completed nor expired"
+        return self.submitted - self.complete - self.expired
+
+    def reserve(self):
+        "count one more probe in flight, unless that would exceed the cap"
+        with self.lock:
+            if self.cap is not None and self.outstanding >= self.cap:
+                self.capped = True
+                return False
+            self.outstanding += 1
+            return True
+
+    def addVP(self, vp):
+        with self.lock:
+            self.members[vp.vpName] = vp
+            self.active.add(vp.vpName)
+            self.responding.add(vp.vpName)
+            self.changes += 1
+        self.watch(vp.vpName, vp.getLastAct() + vp.timeout)
+
+    def vpState(self, name, active, responding):
+        with self.lock:
+            for (members, member) in ((self.active, active), (self.responding, responding)):
+                if member:
+                    members.add(name)
+                else:
+                    members.discard(name)
+            self.changes += 1
+
+    def vpStopped(self, name):
+        with self.lock:
+            self.stopped.add(name)
+            self.changes += 1
+
+    def watch(self, name, deadline):
+        with self.lock:
+            heapq.heappush(self.deadlines, (deadline, name))
+
+    def expire(self, now=None):
+        if now is None:
+            now = time.time()
+        while True:
+            with self.lock:
+                if not self.deadlines or self.deadlines[0][0] > now:
+                    return
+                (deadline, name) = heapq.heappop(self.deadlines)
+            self.members[name].refreshState(rearm=True)
+
+    def percentiles(self, qs=(50, 95, 99)):
+        with self.lock:
+            return self.sketch.percentiles(qs)
+
+    def snapshot(self):
+        self.expire()
+        with self.lock:
+            (p50, p95, p99) = self.sketch.percentiles((50, 95, 99))
+            return {'rtt_p50': p50,
+                    'rtt_p95': p95,
+                    'rtt_p99': p99,
+                    'probes_submitted': self.submitted,
+                    'probes_waiting': self.waiting,
+                    'probes_active': self.outstanding,
+                    'probes_complete': self.complete,
+                    'probes_expired': self.expired,
+                    'targets_remaining': self.remaining(),
+                    'vps_used': len(self.members),
+                    'vps_alive': len(self.members) - len(self.stopped),
+                    'vps_active': len(self.active),
+                    'vps_responding': len(self.responding),
+                    'vps_not_responding': len(self.members) - len(self.responding),
+                    'vps_stopped': len(self.stopped)}
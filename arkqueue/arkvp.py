@@ -4,37 +4,70 @@
 # Author:       Justin P. Rohrer <jprohrer@nps.edu>
 # Description:  Class for managing probes to be executed from a particular ARK vantage point
 
-import sys, time, subprocess, select
+import os, sys, time, select
+import heapq
+import collections
 import Queue
 import logging
 from threading import Thread
 from threading import Event
+from threading import Lock
 #from threading import Timer
 #import tod
 from counter import Counter
+from arkstats import ArkStats
+from rtthistory import RTTHistory, RTTSketch
+from concurrency import AIMDLimit
+from spillqueue import SpillQueue
+from metrics import Metrics
+from transport import SubprocessTransport
 
 
 class ArkVP(Thread):
-    def __init__(self, vpName, counter, result_queue, sessionIdBase=None, concurrency=100, timeout=600, reanimate=True, window_max=10080, loggingLevel=logging.WARNING):
+    def __init__(self, vpName, counter, result_queue, sessionIdBase=None, concurrency=100, timeout=600, reanimate=True, window_max=10080, loggingLevel=logging.WARNING, stats=None, journal=None, gate=None, adaptive=False, max_concurrency=None, spill_dir=None, spill_items=10000, metrics=None, transport=None, deadline=None):
         Thread.__init__(self)
         self.vpName = vpName
         self.sessionId = sessionIdBase + ':' + vpName
         self.probenum = counter
         self.results = result_queue
         self.concurrency = concurrency
+        self.limiter = None
+        if adaptive:
+            # start at concurrency, let tod-client run as many as the limit may grow to
+            self.limiter = AIMDLimit(concurrency, maximum=max_concurrency or 4 * concurrency)
+            self.concurrency = self.limiter.maximum
         self.timeout = timeout
         self.reanimate = reanimate
         self.max_rtt_hist = window_max
         self.lastActTime = time.time()
-        self.probesWaiting = Queue.PriorityQueue()
+        self.spill_dir = spill_dir
+        self.spill_items = spill_items
+        self.probesWaiting = self.newWaitingQueue()
         self.probesOutstanding = dict()
         self.timestamps = dict()
-        self.RTTs = list()
+        self.deadline = deadline        # seconds a request may stay outstanding before it is given up on
+        self.deadlines = []             # heap of (due, reqid, priority), including requests answered since
+        self.expiredIds = collections.OrderedDict()     # recently expired reqids, to recognize late answers
+        self.buffer = ''                # partial line read from tod-client
+        self.RTTs = RTTHistory(self.max_rtt_hist)
+        self.sketch = RTTSketch()
         self.totalRequests = 0
         self.completedRequests = 0
         self.exitEvent = Event()
+        self.wakeEvent = Event()    # set whenever a slot frees up or new work arrives
         #self.tracenum = 1
         self.responsive = True
+        self.stateActive = True         # last state reported to self.stats
+        self.stateResponding = True
+        self.stateLock = Lock()
+        if stats is None:
+            stats = ArkStats()
+        self.stats = stats
+        self.journal = journal
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+        self.gate = gate                # cleared while results are backing up; no new probes are sent
         #signal.signal(signal.SIGINT, self.signal_handler)	# Signal only works in main thread
         
         # create logger
@@ -52,14 +85,31 @@ class ArkVP(Thread):
         # add ch to logger
         self.logger.addHandler(ch)
         
-        self.todClient = subprocess.Popen(['./tod-client', '--session-id='+self.sessionId,'--concurrency='+str(self.concurrency)],shell=False,stdin=subprocess.PIPE,stdout=subprocess.PIPE)
+        if transport is None:
+            transport = SubprocessTransport
+        self.todClient = transport(self.sessionId, self.concurrency)
+        self.stats.addVP(self)
         
     #def signal_handler(self, signal, frame):
     #    self.exit()
     
-    def addProbe(self, target, priority):
-        self.probesWaiting.put([priority,target])
+    def addProbe(self, target, priority, queued=None):
+        self.probesWaiting.put([priority,target,queued or time.time()])
         self.totalRequests += 1
+        self.stats.count(submitted=1, waiting=1)
+        self.wakeEvent.set()
+    
+    # With a spill_dir, probes past spill_items wait on disk instead of in memory
+    def newWaitingQueue(self):
+        if self.spill_dir:
+            return SpillQueue(memory_items=self.spill_items, spill_dir=self.spill_dir)
+        return Queue.PriorityQueue()
+    
+    def clearWaiting(self):
+        self.stats.count(waiting=-self.probesWaiting.qsize())
+        (waiting, self.probesWaiting) = (self.probesWaiting, self.newWaitingQueue())
+        if isinstance(waiting, SpillQueue):
+            waiting.close()
     
     def getWaiting(self):
         return self.probesWaiting.qsize()
@@ -79,15 +129,16 @@ class ArkVP(Thread):
     def getIncomplete(self):
         return self.totalRequests - self.completedRequests
     
+    def getLimit(self):
+        if self.limiter:
+            return self.limiter.limit
+        return self.concurrency
+    
     def getRTT(self, window=1):
-        window = max(min(window, len(self.RTTs)), 1)
-        sum_rtt = 0
-        last_rtt = len(self.RTTs) - 1
-        if last_rtt >= 0 and last_rtt >= window-1:
-            for i in range(window):
-                sum_rtt += self.RTTs[last_rtt-i]
-        
-        return sum_rtt / window
+        return self.RTTs.mean(window)
+    
+    def getRTTPercentiles(self, qs=(50, 95, 99)):
+        return self.sketch.percentiles(qs)
     
     def isActive(self):
         return (time.time() - self.lastActTime) < self.timeout
@@ -104,6 +155,23 @@ class ArkVP(Thread):
         
         return self.responsive
     
+    # Push any change in isActive()/isResponding() to self.stats. Called on
+    # every send and completion, and by ArkStats.expire() once the activity
+    # deadline armed here has passed (rearm=True).
+    def refreshState(self, rearm=False):
+        with self.stateLock:
+            active = self.isActive()
+            responding = self.isResponding()
+            if active and (rearm or not self.stateActive):
+                self.stats.watch(self.vpName, self.lastActTime + self.timeout)
+            if self.limiter and self.stateResponding and not responding:
+                self.limiter.unresponsive()
+            if responding != self.stateResponding:
+                self.metrics.inc('arkqueue_vp_transitions_total', vp=self.vpName, to='responding' if responding else 'not_responding')
+            if (active, responding) != (self.stateActive, self.stateResponding):
+                (self.stateActive, self.stateResponding) = (active, responding)
+                self.stats.vpState(self.vpName, active, responding)
+    
     def printActive(self):
         if self.isActive():
             sys.stdout.write('!')
@@ -120,18 +188,13 @@ class ArkVP(Thread):
         print "Ark vantage point name:", self.vpName
         print "Probes submitted:", self.getTotal()
         print "Probes completed:", self.getComplete()
-        print "Probes incomplete:", self.getIncomplete(), "\n"
+        print "Probes incomplete:", self.getIncomplete()
+        print "Concurrency limit:", self.getLimit(), "\n"
     
     def clearTod(self):
-        todDebug = subprocess.Popen(['./tod-debug', '--session-id='+self.sessionId,'--clear-requests'],shell=False,stdout=subprocess.PIPE)
-        #todDebug = subprocess.Popen(['./tod-debug', '--session-id='+self.sessionId,'--clear-requests'])
-        try:
-            fdready = select.select([todDebug.stdout], [], [], 30)
-        except select.error as ex:
-            self.logger.warning("Select error: " + str(ex))
-        if len(fdready[0]) > 0:
-            for line in todDebug.stdout:
-                self.logger.debug(line.strip())
+        for line in self.todClient.clear():
+            self.logger.debug(line.strip())
+        self.stats.count(outstanding=-len(self.probesOutstanding))
         self.probesOutstanding.clear()
     
     #def clearTod(self):
@@ -144,9 +207,9 @@ class ArkVP(Thread):
     def stop(self):
         if self.is_alive():
             self.logger.debug("Thread stopping.")
-            self.probesWaiting = Queue.PriorityQueue()
+            self.clearWaiting()
             self.rt.join()
-            self.todClient.terminate()
+            self.todClient.close()
             #todDebug = subprocess.Popen(['./tod-debug', '--session-id='+self.sessionId,'--clear-requests'],shell=False,stdin=subprocess.PIPE,stdout=subprocess.PIPE)
             #try:
             #    fdready = select.select([todDebug.stdout], [], [], 60)
@@ -163,12 +226,138 @@ class ArkVP(Thread):
             #self.probesOutstanding.clear()
             self.clearTod()
     
+    def receiveData(self, data):
+        lines = (self.buffer + data).split('\n')
+        self.buffer = lines.pop()
+        self.receiveLines([line + '\n' for line in lines])
+    
+    def receiveLine(self, out):
+        self.receiveLines([out])
+    
+    # Everything read in one wakeup goes to the callback thread as one batch
+    def receiveLines(self, lines):
+        finished = list()
+        for out in lines:
+            result = self.completeProbe(out)
+            if result:
+                finished.append(result)
+        if finished:
+            if self.limiter:
+                self.limiter.completed(self.RTTs, len(finished))
+            self.results.put([3, finished])
+            self.refreshState()
+            self.wakeEvent.set()
+    
+    def completeProbe(self, out):
+        fields = out.split(None, 1)
+        if len(fields) > 0:
+            try:
+                reqid = int(fields[0])
+            except ValueError:
+                self.logger.warning("Ignoring unexpected line from tod-client: " + out.strip())
+                return None
+            # whichever of this and expireRequests pops the request owns it
+            probe = self.probesOutstanding.pop(reqid, None)
+            if probe is not None:
+                self.lastActTime = time.time()
+                rtt = self.lastActTime - self.timestamps.pop(reqid)[0]
+                self.logger.debug("Probe # " + str(reqid) + " took " + str(rtt) + " s")
+                self.RTTs.append(rtt)
+                self.sketch.add(rtt)
+                self.completedRequests += 1
+                self.stats.count(outstanding=-1, complete=1, rtt=rtt)
+                self.metrics.observe('arkqueue_tod_seconds', rtt, vp=self.vpName)
+                #self.finish_hook(out, [self.vpName, self.probesOutstanding[reqid]])
+                return (out, [self.vpName, probe])
+            elif reqid in self.expiredIds:
+                self.logger.debug("Discarding late answer to expired request ID: " + str(reqid))
+                self.metrics.inc('arkqueue_vp_late_answers_total', vp=self.vpName)
+            else:
+                self.logger.warning("Received unexpected request ID: " + str(reqid))
+    
+    def sendProbes(self):
+        sent = list()
+        if self.gate is not None and not self.gate.isSet():
+            return
+        while len(self.probesOutstanding) < self.getLimit():
+            try:
+                [priority,probe,queued] = self.probesWaiting.get_nowait()
+            except Queue.Empty:
+                break
+            if not self.stats.reserve():
+                # global cap reached; ArkStats wakes us once there is room
+                self.probesWaiting.put([priority,probe,queued])
+                self.probesWaiting.task_done()
+                break
+            else:
+                probenum = self.probenum.increment()
+                todstring = str(probenum) + ' ' + self.vpName + ' trace ' + probe
+                try:
+                    self.todClient.write(todstring + "\n")
+                except IOError as ex:
+                    self.logger.error("IO Error: " + str(ex))
+                    self.stats.count(waiting=-1, outstanding=-1)
+                    #if ex.errno == errno.EPIPE:
+                    #    continue
+                else:
+                    self.lastActTime = time.time()
+                    self.timestamps[probenum] = [self.lastActTime, None]
+                    self.probesOutstanding[probenum] = probe
+                    if self.deadline:
+                        heapq.heappush(self.deadlines, (self.lastActTime + self.deadline, probenum, priority))
+                    self.stats.count(waiting=-1)
+                    self.metrics.observe('arkqueue_queue_wait_seconds', self.lastActTime - queued, vp=self.vpName)
+                    if self.journal:
+                        self.journal.submitted(probenum, self.vpName, probe)
+                    #self.tracenum += 1
+                self.probesWaiting.task_done()
+                sent.append([self.vpName, probe])
+        if self.limiter and len(self.probesOutstanding) >= self.limiter.limit:
+            self.limiter.filled()
+        if sent:
+            self.results.put([2, sent])
+            self.refreshState()
+    
+    # Called from the thread that sends, never concurrently with sendProbes
+    def expireRequests(self, now=None):
+        "give up on requests outstanding past their deadline, freeing their slots; returns them as (vp, target, reqid, priority)"
+        if now is None:
+            now = time.time()
+        expired = list()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            (due, reqid, priority) = heapq.heappop(self.deadlines)
+            probe = self.probesOutstanding.pop(reqid, None)
+            if probe is None:
+                continue        # answered in time, or cleared
+            self.timestamps.pop(reqid, None)
+            self.expiredIds[reqid] = now
+            expired.append((self.vpName, probe, reqid, priority))
+        while len(self.expiredIds) > 65536:
+            self.expiredIds.popitem(last=False)
+        if len(self.deadlines) > 2 * len(self.probesOutstanding) + 1000:
+            # drop the entries of answered requests
+            self.deadlines = [entry for entry in self.deadlines if entry[1] in self.probesOutstanding]
+            heapq.heapify(self.deadlines)
+        if expired:
+            self.logger.debug(str(len(expired)) + " requests passed their " + str(self.deadline) + " s deadline")
+            self.stats.count(outstanding=-len(expired), expired=len(expired))
+            self.metrics.inc('arkqueue_vp_expired_total', len(expired), vp=self.vpName)
+            self.results.put([5, expired])
+            self.refreshState()
+        return expired
+    
+    def nextDeadline(self):
+        "seconds until the earliest deadline, or None"
+        if not self.deadlines:
+            return None
+        return max(self.deadlines[0][0] - time.time(), 0)
+    
     def receive_thread(self):
         while not self.exitEvent.isSet():
             #while len(self.probesOutstanding) > 0 and self.isActive():
                 # wait for data from tod-client (1 sec timeout)
                 try:
-                    fdready = select.select([self.todClient.stdout], [], [], 10)
+                    fdready = select.select([self.todClient], [], [], 10)
                 except select.error  as ex:
                     self.logger.error("Select error: " + str(ex))
                     if ex[0] == 4:
@@ -176,24 +365,12 @@ class ArkVP(Thread):
                     else:
                         raise
                 if len(fdready[0]) > 0:
-                    out = self.todClient.stdout.readline()
-                    if len(out.strip().split()) > 0:
-                        reqid = int(out.strip().split()[0])
-                        if reqid in self.probesOutstanding:
-                            self.lastActTime = time.time()
-                            self.timestamps[reqid][1] = self.lastActTime
-                            rtt = self.timestamps[reqid][1] - self.timestamps[reqid][0]
-                            self.logger.debug("Probe # " + str(reqid) + " took " + str(rtt) + " s")
-                            self.RTTs.append(rtt)
-                            del self.timestamps[reqid]
-                            while len(self.RTTs) > self.max_rtt_hist:
-                                self.timestamps.pop(0)
-                            self.completedRequests += 1
-                            #self.finish_hook(out, [self.vpName, self.probesOutstanding[reqid]])
-                            self.results.put([3,[out, [self.vpName, self.probesOutstanding[reqid]]]])
-                            del self.probesOutstanding[reqid]
-                        else:
-                            self.logger.warning("Received unexpected request ID: " + str(reqid))
+                    # take every line available, not one per select()
+                    data = os.read(self.todClient.fileno(), 65536)
+                    if not data:
+                        self.logger.error("tod-client closed its output.")
+                        break
+                    self.receiveData(data)
             
             #time.sleep(60)
     
@@ -202,38 +379,23 @@ class ArkVP(Thread):
         self.rt.daemon = True
         self.rt.start()
         while not self.exitEvent.isSet():
+            # Clear before draining so a completion or addProbe racing with the fill loop still wakes us
+            self.wakeEvent.clear()
             self.logger.debug("Probes active: " + str(len(self.probesOutstanding)) + " Targets remaining: " + str(self.probesWaiting.qsize()) + " Time since activity: " + str(time.time() - self.lastActTime))
-            while len(self.probesOutstanding) < self.concurrency:
-                try:
-                    [priority,probe] = self.probesWaiting.get(timeout=10)
-                except Queue.Empty:
-                    break
-                else:
-                    probenum = self.probenum.increment()
-                    todstring = str(probenum) + ' ' + self.vpName + ' trace ' + probe
-                    try:
-                        self.todClient.stdin.write(todstring + "\n")
-                    except IOError as ex:
-                        self.logger.error("IO Error: " + str(ex))
-                        #if ex.errno == errno.EPIPE:
-                        #    continue
-                    else:
-                        self.lastActTime = time.time()
-                        self.probesOutstanding[probenum] = probe
-                        self.timestamps[probenum] = [self.lastActTime, None]
-                        #self.tracenum += 1
-                    self.probesWaiting.task_done()
-                    self.results.put([2, [self.vpName, probe]])
+            self.expireRequests()
+            self.sendProbes()
             
-            time.sleep(10)
+            self.wakeEvent.wait(self.nextDeadline())
         
         self.stop()
+        self.stats.vpStopped(self.vpName)
             
     def exit(self):
         if self.exitEvent.isSet():
             return
         self.logger.debug("Thread asked to exit.")
         self.exitEvent.set()
+        self.wakeEvent.set()
         #self.stop()
         #self.logger.info("Thread waiting to exit.")
         #self.join()    # Cannot join current thread
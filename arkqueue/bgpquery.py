@@ -9,6 +9,11 @@
 
 from socket import *
 import sys
+import struct
+import binascii
+import collections
+import threading
+import Queue
 
 class BGPquery:
     def __init__(self, host, port, debug=False):
@@ -40,7 +45,11 @@ class BGPquery:
         return self.read()
 
     def read(self):
-        response = self.sock.recv(1024).rstrip()
+        return self.parse(self.sock.recv(1024))
+
+    @staticmethod
+    def parse(response):
+        response = response.rstrip()
         (ip, mask, asn) = (0, 0, 0)
         if (response.find("not found") == -1) and (response.find("end") == -1):
             if response.find(",") != -1:
@@ -49,3 +58,196 @@ class BGPquery:
                 prefix = response
             (ip, mask) = prefix.split("/")
         return (ip, mask, asn)
+
+
+def addrToNum(ip):
+    "convert an IPv4 or IPv6 address string to (family, bits, long integer), or None"
+    try:
+        return (AF_INET, 32, struct.unpack('!I', inet_pton(AF_INET, ip))[0])
+    except (error, ValueError, TypeError):
+        pass
+    try:
+        return (AF_INET6, 128, long(binascii.hexlify(inet_pton(AF_INET6, ip)), 16))
+    except (error, ValueError, TypeError):
+        return None
+
+# LRU of daemon answers keyed by the prefix the daemon returned, so any
+# later address inside an already known prefix is answered locally.
+# Addresses the daemon could not find are remembered individually.
+class PrefixCache:
+    def __init__(self, size=65536):
+        self.size = size
+        self.prefixes = collections.OrderedDict()   # (family, masklen, network) -> (ip, mask, asn)
+        self.misses = collections.OrderedDict()     # ip -> (0, 0, 0)
+        self.masklens = {AF_INET: dict(), AF_INET6: dict()}    # masklen -> cached prefixes of that length
+        self.order = {AF_INET: [], AF_INET6: []}    # masklens, longest first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.lookups = 0
+
+    def get(self, ip):
+        with self.lock:
+            self.lookups += 1
+            if ip in self.misses:
+                self.hits += 1
+                result = self.misses.pop(ip)
+                self.misses[ip] = result
+                return result
+            addr = addrToNum(ip)
+            if addr is None:
+                return None
+            (family, bits, num) = addr
+            for masklen in self.order[family]:
+                key = (family, masklen, num >> (bits - masklen))
+                if key in self.prefixes:
+                    self.hits += 1
+                    result = self.prefixes.pop(key)
+                    self.prefixes[key] = result
+                    return result
+            return None
+
+    def put(self, ip, result):
+        with self.lock:
+            (pfx, mask, asn) = result
+            addr = addrToNum(pfx) if mask else None
+            if addr is None:
+                self.misses[ip] = result
+                if len(self.misses) > self.size:
+                    self.misses.popitem(last=False)
+                return
+            (family, bits, num) = addr
+            masklen = int(mask)
+            key = (family, masklen, num >> (bits - masklen))
+            if key in self.prefixes:
+                del self.prefixes[key]
+            else:
+                self.addMasklen(family, masklen, 1)
+            self.prefixes[key] = result
+            if len(self.prefixes) > self.size:
+                (old, tmp) = self.prefixes.popitem(last=False)
+                self.addMasklen(old[0], old[1], -1)
+
+    def addMasklen(self, family, masklen, delta):
+        count = self.masklens[family].get(masklen, 0) + delta
+        if count > 0:
+            self.masklens[family][masklen] = count
+        else:
+            del self.masklens[family][masklen]
+        if count == delta or count == 0:
+            self.order[family] = sorted(self.masklens[family], reverse=True)
+
+    def clear(self):
+        with self.lock:
+            self.prefixes.clear()
+            self.misses.clear()
+            for family in self.masklens:
+                self.masklens[family].clear()
+                self.order[family] = []
+
+# Thread-safe BGP daemon client: keeps a pool of persistent connections,
+# pipelines up to depth queries per write, and fronts them with a PrefixCache.
+class BGPclient:
+    def __init__(self, host="localhost", port=2000, connections=4, depth=256, cache_size=65536, debug=False):
+        self.server = (host, port)
+        self.depth = depth
+        self.debug = debug
+        self.idle = Queue.LifoQueue()
+        self.slots = threading.Semaphore(connections)
+        if cache_size:
+            self.cache = PrefixCache(cache_size)
+        else:
+            self.cache = None
+
+    def acquire(self):
+        self.slots.acquire()
+        try:
+            return self.idle.get_nowait()
+        except Queue.Empty:
+            pass
+        try:
+            conn = BGPquery(self.server[0], self.server[1], debug=self.debug)
+            conn.connect()
+            conn.rfile = conn.sock.makefile('rb')
+        except:
+            self.slots.release()
+            raise
+        return conn
+
+    def release(self, conn, broken=False):
+        if broken:
+            conn.sock.close()
+        else:
+            self.idle.put(conn)
+        self.slots.release()
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().sock.close()
+            except Queue.Empty:
+                break
+
+    def query(self, ips):
+        results = []
+        conn = self.acquire()
+        try:
+            for start in range(0, len(ips), self.depth):
+                chunk = ips[start:start + self.depth]
+                if self.debug:
+                    print "Issuing", len(chunk), "pipelined queries"
+                conn.sock.sendall(''.join(["s " + ip + "\n" for ip in chunk]))
+                for ip in chunk:
+                    response = conn.rfile.readline()
+                    if not response:
+                        raise error("BGP daemon closed the connection")
+                    results.append(BGPquery.parse(response))
+        except:
+            self.release(conn, broken=True)
+            raise
+        self.release(conn)
+        return results
+
+    def lookup(self, ip):
+        return self.lookupMany([ip])[0]
+
+    # Queries go out depth at a time and the cache is consulted between
+    # rounds, so most of a large batch is answered by prefixes learned early.
+    def lookupMany(self, ips):
+        results = [None] * len(ips)
+        pending = collections.OrderedDict()     # ip -> indices of results waiting on it
+        for i in range(len(ips)):
+            if ips[i] in pending:
+                pending[ips[i]].append(i)
+                continue
+            if self.cache:
+                results[i] = self.cache.get(ips[i])
+            if results[i] is None:
+                pending[ips[i]] = [i]
+                if len(pending) >= self.depth:
+                    self.resolve(pending, results)
+                    pending = collections.OrderedDict()
+        if pending:
+            self.resolve(pending, results)
+        return results
+
+    def resolve(self, pending, results):
+        queries = pending.keys()
+        try:
+            answers = self.query(queries)
+        except error:
+            answers = self.query(queries)   # retry once on a fresh connection
+        for (ip, answer) in zip(queries, answers):
+            if self.cache:
+                self.cache.put(ip, answer)
+            for i in pending[ip]:
+                results[i] = answer
+
+_shared = dict()
+_shared_lock = threading.Lock()
+
+def shared(host="localhost", port=2000):
+    "return the process-wide BGPclient for host:port"
+    with _shared_lock:
+        if (host, port) not in _shared:
+            _shared[(host, port)] = BGPclient(host, port)
+        return _shared[(host, port)]
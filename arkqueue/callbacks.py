@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+#
+# Program:      $Id$
+# Description:  Timed, optionally parallel execution of ArkQueue's submit and finish hooks
+
+import time
+import pickle
+import collections
+import traceback
+import logging
+import threading
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+from rtthistory import RTTSketch
+
+def _run(hook, args, queued):
+    started = time.time()
+    try:
+        hook(*args)
+    except Exception:
+        return (queued, started, time.time(), traceback.format_exc())
+    return (queued, started, time.time(), None)
+
+
+class HookStats(object):
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.wait = 0.0
+        self.busy = 0.0
+        self.max = 0.0
+        self.sketch = RTTSketch(min_rtt=0.00001)
+
+    def add(self, queued, started, ended, error):
+        self.calls += 1
+        self.errors += error is not None
+        self.wait += started - queued
+        self.busy += ended - started
+        self.max = max(self.max, ended - started)
+        self.sketch.add(ended - started)
+
+    def snapshot(self):
+        (p50, p95, p99) = self.sketch.percentiles((50, 95, 99))
+        return {'calls': self.calls,
+                'errors': self.errors,
+                'wait_mean': self.wait / self.calls if self.calls else 0,
+                'mean': self.busy / self.calls if self.calls else 0,
+                'max': self.max,
+                'p50': p50,
+                'p95': p95,
+                'p99': p99}
+
+
+class CallbackExecutor(object):
+    # workers=0 calls each hook in the caller's thread, as ArkQueue always
+    # has. Otherwise hooks run on a pool of worker threads, or of processes
+    # for CPU-bound hooks (hooks and their arguments must then be picklable,
+    # and the pool should be created before ArkQueue starts any threads).
+    # With ordered=True the callbacks sharing a key (ArkQueue uses the
+    # vantage point) run one at a time in submission order; different keys
+    # still run in parallel. submit() blocks once max_inflight callbacks are
+    # queued or running.
+    def __init__(self, workers=4, processes=False, ordered=False, max_inflight=1000, loggingLevel=logging.INFO):
+        self.workers = workers
+        self.ordered = ordered
+        self.processes = processes
+        self.pool = None
+        if workers and processes:
+            self.pool = Pool(workers)
+        elif workers:
+            self.pool = ThreadPool(workers)
+        self.slots = threading.BoundedSemaphore(max_inflight)
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.inflight = 0
+        self.running = dict()       # ordered mode: key -> callbacks waiting behind the one running
+        self.hooks = dict()
+        self.checked = set()
+        self.metrics = None         # a metrics.Metrics to also record each call's run time in
+
+        self.logger = logging.getLogger('[' + self.__class__.__name__ + ']')
+        if loggingLevel:
+            self.logger.setLevel(loggingLevel)
+        ch = logging.StreamHandler()
+        if loggingLevel:
+            ch.setLevel(loggingLevel)
+        formatter = logging.Formatter("%(asctime)s - %(name)s:%(levelname)s: %(message)s")
+        ch.setFormatter(formatter)
+        self.logger.addHandler(ch)
+
+    def record(self, name, queued, started, ended, error):
+        with self.lock:
+            if name not in self.hooks:
+                self.hooks[name] = HookStats()
+            self.hooks[name].add(queued, started, ended, error)
+        if self.metrics:
+            self.metrics.observe('arkqueue_callback_seconds', ended - started, hook=name)
+
+    def submit(self, name, hook, args, key=None, done=None):
+        "run hook(*args), then done() if it succeeded"
+        queued = time.time()
+        if self.pool is None:
+            started = time.time()
+            try:
+                hook(*args)
+            except Exception:
+                self.record(name, queued, started, time.time(), traceback.format_exc())
+                raise
+            self.record(name, queued, started, time.time(), None)
+            if done:
+                done()
+            return
+        if self.processes and name not in self.checked:
+            pickle.dumps((hook, args))      # fail here rather than silently inside the pool
+            self.checked.add(name)
+        self.slots.acquire()
+        task = (name, hook, args, queued, done)
+        with self.lock:
+            self.inflight += 1
+            if self.ordered:
+                if key in self.running:
+                    self.running[key].append(task)
+                    return
+                self.running[key] = collections.deque()
+        self.launch(task, key)
+
+    def launch(self, task, key):
+        (name, hook, args, queued, done) = task
+        self.pool.apply_async(_run, (hook, args, queued), callback=lambda result: self.finished(name, key, done, result))
+
+    # Runs in the pool's result thread
+    def finished(self, name, key, done, result):
+        (queued, started, ended, error) = result
+        self.record(name, queued, started, ended, error)
+        if error:
+            self.logger.error(name + " failed: " + error)
+        elif done:
+            try:
+                done()
+            except Exception:
+                self.logger.error(traceback.format_exc())
+        task = None
+        with self.lock:
+            self.inflight -= 1
+            if self.ordered:
+                if self.running[key]:
+                    task = self.running[key].popleft()
+                else:
+                    del self.running[key]
+            if self.inflight == 0:
+                self.idle.notify_all()
+        self.slots.release()
+        if task:
+            self.launch(task, key)
+
+    def getInflight(self):
+        return self.inflight
+
+    def stats(self):
+        "{hook name: latency and error counters}"
+        with self.lock:
+            return dict((name, hook.snapshot()) for (name, hook) in self.hooks.iteritems())
+
+    def wait(self):
+        with self.lock:
+            while self.inflight > 0:
+                self.idle.wait(1)
+
+    def close(self):
+        self.wait()
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
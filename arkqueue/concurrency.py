@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+#
+# Program:      $Id$
+# Description:  Additive-increase/multiplicative-decrease limit on the probes a vantage point keeps in flight
+
+
+class AIMDLimit(object):
+    # Adjusted once per round, i.e. once as many probes as the current limit
+    # have completed. If the mean completion time of that round stays within
+    # tolerance of the baseline, the limit grows by `increase`; otherwise it
+    # is multiplied by `decrease`. The baseline is the best round seen, and
+    # drifts up slowly so a lasting change in path latency is not mistaken
+    # for congestion forever. The limit only grows in rounds where it was
+    # actually reached, not while the VP is short of work or held back by
+    # a global cap.
+    def __init__(self, initial, minimum=1, maximum=1000, increase=1, decrease=0.5, tolerance=0.2, drift=0.1):
+        self.minimum = minimum
+        self.maximum = max(maximum, minimum)
+        self.limit = min(max(initial, minimum), self.maximum)
+        self.increase = increase
+        self.decrease = decrease
+        self.tolerance = tolerance
+        self.drift = drift
+        self.baseline = None
+        self.completions = 0
+        self.saturated = False
+
+    def filled(self):
+        "the vantage point had as many probes in flight as the limit allows"
+        self.saturated = True
+
+    def completed(self, rtts, n=1):
+        "n more probes finished; rtts is the vantage point's RTTHistory"
+        self.completions += n
+        if self.completions < self.limit:
+            return self.limit
+        recent = rtts.mean(window=self.completions)
+        self.completions = 0
+        if self.baseline is None or recent < self.baseline:
+            self.baseline = recent
+        if recent <= self.baseline * (1 + self.tolerance):
+            if self.saturated:
+                self.limit = min(self.limit + self.increase, self.maximum)
+        else:
+            self.limit = max(int(self.limit * self.decrease), self.minimum)
+            self.baseline += (recent - self.baseline) * self.drift
+        self.saturated = False
+        return self.limit
+
+    def unresponsive(self):
+        self.limit = self.minimum
+        self.completions = 0
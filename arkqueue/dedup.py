@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+#
+# Program:      $Id$
+# Description:  Collapses duplicate (vp, target) requests and remembers recent results for reuse
+
+import time
+import collections
+from threading import Lock
+
+
+class ResultCache(object):
+    # A (vp, target) already queued or in flight is not sent to ToD again;
+    # the request just waits for that result. Finished results are kept for
+    # ttl seconds, at most maxsize of them (least recently used go first),
+    # and answer new requests without probing. A request in flight for
+    # longer than stale seconds is assumed lost (e.g. its VP was stopped),
+    # so the next duplicate probes again. Should the old request turn up
+    # after all, whichever result arrives first goes to every requester and
+    # the other one is surplus: complete() returns -1 for it.
+    def __init__(self, ttl=600, maxsize=100000, stale=3600):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.stale = stale
+        self.lock = Lock()
+        self.results = collections.OrderedDict()    # (vp, target) -> (finished time, out)
+        self.inflight = dict()                      # (vp, target) -> [queued time, requesters waiting, probes in flight]
+        self.hits = 0
+        self.collapsed = 0
+        self.misses = 0
+
+    def request(self, vp, trg, now=None):
+        "return ('probe', None), ('wait', None) or ('cached', out)"
+        if now is None:
+            now = time.time()
+        key = (vp, trg)
+        with self.lock:
+            if key in self.results:
+                (finished, out) = self.results.pop(key)
+                if now - finished < self.ttl:
+                    self.results[key] = (finished, out)     # most recently used goes last
+                    self.hits += 1
+                    return ('cached', out)
+            if key in self.inflight:
+                entry = self.inflight[key]
+                entry[1] += 1
+                if now - entry[0] < self.stale:
+                    self.collapsed += 1
+                    return ('wait', None)
+                entry[0] = now
+                entry[2] += 1
+            else:
+                self.inflight[key] = [now, 1, 1]
+            self.misses += 1
+            return ('probe', None)
+
+    def complete(self, vp, trg, out, now=None):
+        "remember out, return how many collapsed duplicates also get it, or -1 if every requester already has a result"
+        if now is None:
+            now = time.time()
+        key = (vp, trg)
+        with self.lock:
+            entry = self.inflight.get(key, [now, 1, 1])
+            waiting = entry[1] - 1
+            entry[1] = 0
+            entry[2] -= 1
+            if entry[2] <= 0:
+                self.inflight.pop(key, None)
+            self.results.pop(key, None)
+            self.results[key] = (now, out)
+            while len(self.results) > self.maxsize:
+                self.results.popitem(last=False)
+            return waiting
+
+    def move(self, vp, trg, newvp):
+        "a request is being retried on newvp; unless another probe is still in flight for them, its requesters get that result instead"
+        with self.lock:
+            if (vp, trg) in self.inflight:
+                old = self.inflight[(vp, trg)]
+                old[2] -= 1
+                entry = self.inflight.setdefault((newvp, trg), [old[0], 0, 0])
+                entry[2] += 1
+                if old[2] <= 0:
+                    del self.inflight[(vp, trg)]
+                    entry[0] = min(entry[0], old[0])
+                    entry[1] += old[1]
+
+    def abandon(self, vp, trg):
+        "a request was given up on; return how many duplicates waited on it in vain"
+        with self.lock:
+            entry = self.inflight.get((vp, trg))
+            if entry is None:
+                return 0
+            entry[2] -= 1
+            if entry[2] > 0:
+                return 0        # another probe is still in flight for them
+            del self.inflight[(vp, trg)]
+            return max(entry[1] - 1, 0)
+
+    def stats(self):
+        with self.lock:
+            return {'cache_hits': self.hits,
+                    'duplicates_collapsed': self.collapsed,
+                    'cache_misses': self.misses,
+                    'cached_results': len(self.results),
+                    'requests_inflight': len(self.inflight)}
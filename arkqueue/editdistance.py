@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+#
+# Program:      $Id$
+# Description:  Path edit distances with the same semantics as ToD.ED and ToD.ED2,
+#               for single pairs and vectorized over many pairs at once
+
+import numpy as np
+from multiprocessing import Pool
+
+CONSERVATIVE_NONE = 99999   # what ToD.ED2 returns when there is nothing to compare
+
+def levenshtein(s, t, bound=None):
+    "ToD.ED: unit-cost edit distance; anything over bound is reported as bound + 1"
+    if len(s) < len(t):
+        (s, t) = (t, s)     # keep only a row as long as the shorter path
+    n = len(t)
+    prev = range(n + 1)
+    for i in range(1, len(s) + 1):
+        a = s[i-1]
+        cur = [i] * (n + 1)
+        left = i
+        for j in range(1, n + 1):
+            if a == t[j-1]:
+                left = prev[j-1]
+            else:
+                left = min(prev[j], left, prev[j-1]) + 1
+            cur[j] = left
+        if bound is not None and min(cur) > bound:
+            return bound + 1
+        prev = cur
+    if bound is not None and prev[n] > bound:
+        return bound + 1
+    return prev[n]
+
+def conservative(s, t):
+    "ToD.ED2: a matching hop resets the distance, result is the best over the last row"
+    if len(s) > len(t):
+        (s, t) = (t, s)
+    m = len(s) + 1
+    prev = range(m)
+    mm = CONSERVATIVE_NONE
+    for j in range(1, len(t) + 1):
+        b = t[j-1]
+        cur = [j] * m
+        up = j
+        for i in range(1, m):
+            if s[i-1] == b:
+                up = 0
+            else:
+                up = min(up, prev[i], prev[i-1]) + 1
+            cur[i] = up
+        if cur[m-1] < mm:
+            mm = cur[m-1]
+        prev = cur
+    return mm
+
+def encode(paths):
+    "map ToD objects or lists of hops to lists of integer ids with the same equality"
+    paths = list(paths)
+    if paths and all(hasattr(path, 'getHopIDs') and path._table is paths[0]._table for path in paths):
+        # ids are only comparable within one AddressTable; q hops and a
+        # literal 0.0.0.0 compare equal as hop strings, so fold them together
+        return [[max(hopid, 0) for hopid in path.getHopIDs()] for path in paths]
+    ids = dict()
+    encoded = list()
+    for path in paths:
+        if hasattr(path, 'getHopIDs'):
+            path = path.hops
+        encoded.append([ids.setdefault(hop, len(ids)) for hop in path])
+    return encoded
+
+def pad(paths):
+    lengths = np.array([len(p) for p in paths], dtype=np.int32)
+    padded = np.full((len(paths), max(lengths.max(), 1) if len(paths) else 1), -1, dtype=np.int64)
+    for (k, p) in enumerate(paths):
+        padded[k, :len(p)] = p
+    return (padded, lengths)
+
+# Dynamic program for many pairs at once. The outer path A is walked one hop
+# at a time; each step updates a whole row over the inner path B for every
+# pair. The in-row dependency cur[k] <= cur[k-1] + 1 is a running minimum of
+# (cur - k), so a row costs a few numpy calls no matter how many pairs.
+def pairDistances(A, la, B, lb, conservative=False, bound=None):
+    P = len(la)
+    width = B.shape[1] + 1
+    k = np.arange(width)
+    rows = np.arange(P)
+    prev = np.tile(k, (P, 1))
+    if conservative:
+        result = np.full(P, CONSERVATIVE_NONE, dtype=np.int64)
+    else:
+        result = lb.astype(np.int64)    # distance from an empty path
+    B = np.where(np.arange(B.shape[1]) < lb[:, None], B, -2)     # A is padded with -1
+    base = np.empty((P, width), dtype=np.int64)
+    a = 0
+    for a in range(1, A.shape[1] + 1):
+        eq = A[:, a-1][:, None] == B
+        base[:, 0] = a
+        step = np.minimum(prev[:, 1:], prev[:, :-1]) + 1
+        if conservative:
+            base[:, 1:] = np.where(eq, 0, step)
+        else:
+            base[:, 1:] = np.where(eq, prev[:, :-1], step)
+        cur = np.minimum.accumulate(base - k, axis=1) + k
+        if conservative:
+            live = a <= la
+            result = np.where(live, np.minimum(result, cur[rows, lb]), result)
+        else:
+            done = la == a
+            result[done] = cur[done, lb[done]]
+            if bound is not None and (cur.min(axis=1)[la > a] > bound).all():
+                break
+        prev = cur
+    if bound is not None:
+        result[result > bound] = bound + 1
+        result[la > a] = bound + 1      # rows skipped after every pair passed the bound
+    return result
+
+def _pairWorker(args):
+    return pairDistances(*args)
+
+def _run(padded, lengths, first, second, conservative, bound, chunk, processes):
+    if conservative:
+        # ToD.ED2 compares the shorter path against the longer one
+        swap = lengths[first] > lengths[second]
+        (first, second) = (np.where(swap, second, first), np.where(swap, first, second))
+        (a, b) = (second, first)    # walk the longer path, rows over the shorter
+    else:
+        (a, b) = (first, second)
+    jobs = list()
+    for start in range(0, len(a), chunk):
+        (ca, cb) = (a[start:start+chunk], b[start:start+chunk])
+        wa = max(lengths[ca].max(), 1) if len(ca) else 1
+        wb = max(lengths[cb].max(), 1) if len(cb) else 1
+        jobs.append((padded[ca, :wa], lengths[ca], padded[cb, :wb], lengths[cb], conservative, bound))
+    if processes and len(jobs) > 1:
+        pool = Pool(processes)
+        try:
+            results = pool.map(_pairWorker, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_pairWorker(job) for job in jobs]
+    if results:
+        return np.concatenate(results)
+    return np.zeros(0, dtype=np.int64)
+
+def distancesTo(path, others, method='ED', bound=None, chunk=20000, processes=None):
+    "distance from one path to each of others, e.g. a new trace against earlier ones"
+    (padded, lengths) = pad(encode([path] + list(others)))
+    second = np.arange(1, len(lengths))
+    first = np.zeros(len(second), dtype=np.int64)
+    return _run(padded, lengths, first, second, method == 'ED2', bound, chunk, processes)
+
+def distanceMatrix(paths, method='ED', bound=None, chunk=20000, processes=None):
+    "N x N matrix where [i, j] is paths[i].ED(hops_i, hops_j) or paths[i].ED2(hops_j)"
+    (padded, lengths) = pad(encode(paths))
+    N = len(lengths)
+    matrix = np.zeros((N, N), dtype=np.int64)
+    if method == 'ED2':
+        (first, second) = np.indices((N, N)).reshape(2, -1)
+        matrix[first, second] = _run(padded, lengths, first, second, True, None, chunk, processes)
+    else:
+        (first, second) = np.triu_indices(N, 1)
+        matrix[first, second] = _run(padded, lengths, first, second, False, bound, chunk, processes)
+        matrix[second, first] = matrix[first, second]
+    return matrix
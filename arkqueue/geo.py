@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+#
+# Program:      $Id$
+# Description:  Nearest monitors to a coordinate, by great-circle distance over the monitors.yaml locations
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0
+
+def haversine(lat, lon, lats, lons):
+    "km from (lat, lon) to each of the arrays lats, lons; all in degrees"
+    (lat, lon) = (np.radians(lat), np.radians(lon))
+    (lats, lons) = (np.radians(lats), np.radians(lons))
+    a = np.sin((lats - lat) / 2) ** 2 + np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class MonitorLocator(object):
+    # Holds the enabled monitors that have a location as NumPy arrays, so a
+    # lookup is one vectorized haversine over all of them (a few hundred at
+    # most, where a k-d tree would not pay for itself). setAvailable()
+    # narrows the candidates, e.g. to ArkQueue's monitor_list once
+    # blacklisted and unresponsive VPs are taken out.
+    def __init__(self, registry):
+        located = [mon for mon in registry if mon.enabled and mon.latitude is not None and mon.longitude is not None]
+        self.names = np.array([mon.name for mon in located], dtype=object)
+        self.index = dict((name, i) for (i, name) in enumerate(self.names))
+        self.lats = np.array([mon.latitude for mon in located], dtype=np.float64)
+        self.lons = np.array([mon.longitude for mon in located], dtype=np.float64)
+        self.available = np.ones(len(located), dtype=bool)
+
+    def mask(self, names):
+        "boolean array selecting these monitors"
+        selected = np.zeros(len(self.names), dtype=bool)
+        for name in names:
+            if name in self.index:
+                selected[self.index[name]] = True
+        return selected
+
+    def setAvailable(self, names):
+        self.available = self.mask(names)
+
+    def distances(self, lat, lon):
+        return haversine(lat, lon, self.lats, self.lons)
+
+    def nearest(self, lat, lon, k=1, mask=None):
+        "[(monitor name, km)] for the k available (and masked, if given) monitors closest to (lat, lon), closest first"
+        candidates = np.flatnonzero(self.available if mask is None else self.available & mask)
+        if len(candidates) == 0:
+            return []
+        km = haversine(lat, lon, self.lats[candidates], self.lons[candidates])
+        if k < len(candidates):
+            closest = np.argpartition(km, k)[:k]
+        else:
+            closest = np.arange(len(candidates))
+        closest = closest[np.argsort(km[closest])]
+        return [(self.names[candidates[i]], float(km[i])) for i in closest]
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+#
+# Program:      $Id$
+# Description:  Append-only on-disk journal of queued, submitted and finished probes, for resuming ArkQueue
+
+import os
+import time
+import collections
+import logging
+from threading import Thread
+from threading import Event
+from threading import Lock
+
+
+class Journal(Thread):
+    # One record per line:
+    #   Q <priority> <vp> <target>    target queued by ArkQueue.addProbe
+    #   S <reqid> <vp> <target>       request handed to tod-client
+    #   F <reqid> <vp> <target>       result delivered to finish_hook
+    #   X <reqid> <vp> <target>       request expired; retried (as a new Q) or given up
+    # Records are buffered in memory and written and fsync'd by this thread
+    # every sync_interval seconds, or sooner once sync_records are waiting,
+    # so journaling never blocks the probing threads on disk. Without resume
+    # an existing journal is renamed aside (to <filename>.<timestamp>), never
+    # truncated. outstanding holds the requests still at ToD when a resumed
+    # journal stopped, by VP, until ArkQueue clears their ToD session.
+    def __init__(self, filename, resume=False, sync_interval=1.0, sync_records=10000, loggingLevel=logging.INFO):
+        Thread.__init__(self)
+        self.daemon = True
+        self.filename = filename
+        self.sync_interval = sync_interval
+        self.sync_records = sync_records
+        self.buffer = list()
+        self.lock = Lock()
+        self.flushLock = Lock()
+        self.exitEvent = Event()
+        self.syncEvent = Event()
+        self.pending = list()
+        self.outstanding = dict()
+        self.maxreqid = 0
+
+        self.logger = logging.getLogger('[' + self.__class__.__name__ + ']')
+        if loggingLevel:
+            self.logger.setLevel(loggingLevel)
+        ch = logging.StreamHandler()
+        if loggingLevel:
+            ch.setLevel(loggingLevel)
+        formatter = logging.Formatter("%(asctime)s - %(name)s:%(levelname)s: %(message)s")
+        ch.setFormatter(formatter)
+        self.logger.addHandler(ch)
+
+        if resume and os.path.exists(filename):
+            (self.pending, self.outstanding, self.maxreqid) = self.replay(filename)
+            self.logger.info("Resuming " + str(len(self.pending)) + " unfinished targets, " +
+                             str(sum(len(r) for r in self.outstanding.values())) + " of them outstanding at ToD when the journal stopped.")
+            self.compact()
+        elif os.path.exists(filename) and os.path.getsize(filename) > 0:
+            rotated = filename + '.' + time.strftime('%Y%m%d-%H%M%S', time.localtime(os.path.getmtime(filename)))
+            os.rename(filename, rotated)
+            self.logger.warning("Journal " + filename + " already exists and resume is off; moved it to " + rotated + ".")
+        self.f = open(filename, 'a')
+        self.start()
+
+    @staticmethod
+    def replay(filename):
+        "return ([priority, vp, target] still unfinished, {vp: [reqid submitted but not finished]}, highest reqid)"
+        queued = collections.OrderedDict()      # (vp, target) -> priorities of unfinished copies, oldest first
+        finished = collections.defaultdict(int)
+        submitted = dict()
+        maxreqid = 0
+        f = open(filename, 'r')
+        for line in f:
+            fields = line.split()
+            if len(fields) != 4 or not line.endswith('\n'):
+                continue    # torn write at the end of a crashed run
+            (kind, num, vp, trg) = fields
+            if kind == 'Q':
+                queued.setdefault((vp, trg), []).append(int(num))
+            elif kind == 'S':
+                submitted[int(num)] = (vp, trg)
+                maxreqid = max(maxreqid, int(num))
+            elif kind in ('F', 'X'):
+                finished[(vp, trg)] += 1
+                submitted.pop(int(num), None)
+        f.close()
+        pending = list()
+        for ((vp, trg), priorities) in queued.iteritems():
+            for priority in priorities[finished.get((vp, trg), 0):]:
+                pending.append([priority, vp, trg])
+        outstanding = collections.defaultdict(list)
+        for (reqid, (vp, trg)) in submitted.iteritems():
+            outstanding[vp].append(reqid)
+        return (pending, dict(outstanding), maxreqid)
+
+    # Rewrite the journal as just the unfinished work, atomically
+    def compact(self):
+        tmpname = self.filename + '.tmp'
+        f = open(tmpname, 'w')
+        f.writelines(['Q %d %s %s\n' % (priority, vp, trg) for (priority, vp, trg) in self.pending])
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.rename(tmpname, self.filename)
+
+    def record(self, kind, num, vp, trg):
+        with self.lock:
+            self.buffer.append('%s %d %s %s\n' % (kind, num, vp, trg))
+            if len(self.buffer) >= self.sync_records:
+                self.syncEvent.set()
+
+    def queued(self, priority, vp, trg):
+        self.record('Q', priority, vp, trg)
+
+    def submitted(self, reqid, vp, trg):
+        self.record('S', reqid, vp, trg)
+
+    def finished(self, reqid, vp, trg):
+        self.record('F', reqid, vp, trg)
+
+    def expired(self, reqid, vp, trg):
+        self.record('X', reqid, vp, trg)
+
+    def flush(self):
+        with self.flushLock:
+            with self.lock:
+                (records, self.buffer) = (self.buffer, list())
+            if records:
+                self.f.writelines(records)
+                self.f.flush()
+                os.fsync(self.f.fileno())
+
+    def run(self):
+        while not self.exitEvent.isSet():
+            self.syncEvent.wait(self.sync_interval)
+            self.syncEvent.clear()
+            self.flush()
+
+    def close(self):
+        if self.exitEvent.isSet():
+            return
+        self.exitEvent.set()
+        self.syncEvent.set()
+        self.join()
+        self.flush()
+        self.f.close()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+#
+# Program:      $Id$
+# Description:  Counters and latency histograms for ArkQueue, as a snapshot or Prometheus text over HTTP
+
+import bisect
+import logging
+from threading import Thread
+from threading import Lock
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+# seconds, from a fast callback up to a slow traceroute
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+def labelText(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for (k, v) in labels) + '}'
+
+
+class Histogram(object):
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        result = list()
+        for (le, n) in zip(list(self.buckets) + ['+Inf'], self.counts):
+            total += n
+            result.append((le, total))
+        return result
+
+
+class Metrics(object):
+    # Counters and histograms are kept here by name and label set; gauges
+    # are read when a snapshot is taken from collectors, functions that
+    # return (name, type, labels dict, value) tuples.
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.lock = Lock()
+        self.counters = dict()      # name -> {label tuple: value}
+        self.histograms = dict()    # name -> {label tuple: Histogram}
+        self.collectors = list()
+
+    def inc(self, name, n=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.counters.setdefault(name, dict())
+            series[key] = series.get(key, 0) + n
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.histograms.setdefault(name, dict())
+            if key not in series:
+                series[key] = Histogram(self.buckets)
+            series[key].observe(value)
+
+    def addCollector(self, collector):
+        self.collectors.append(collector)
+
+    def collect(self):
+        "[(name, type, label tuple, value or Histogram copy)]"
+        samples = list()
+        with self.lock:
+            for (name, series) in self.counters.iteritems():
+                for (key, value) in series.iteritems():
+                    samples.append((name, 'counter', key, value))
+            for (name, series) in self.histograms.iteritems():
+                for (key, hist) in series.iteritems():
+                    copy = Histogram(hist.buckets)
+                    (copy.counts, copy.sum, copy.count) = (list(hist.counts), hist.sum, hist.count)
+                    samples.append((name, 'histogram', key, copy))
+        for collector in self.collectors:
+            for (name, kind, labels, value) in collector():
+                samples.append((name, kind, tuple(sorted(labels.items())), value))
+        return sorted(samples, key=lambda sample: (sample[0], sample[2]))
+
+    def snapshot(self):
+        "{name: [{'labels': {...}, 'value': v} or {'labels': {...}, 'count': n, 'sum': s, 'buckets': [[le, n], ...]}]}"
+        result = dict()
+        for (name, kind, key, value) in self.collect():
+            if kind == 'histogram':
+                sample = {'labels': dict(key), 'count': value.count, 'sum': value.sum,
+                          'buckets': [[le, n] for (le, n) in value.cumulative()]}
+            else:
+                sample = {'labels': dict(key), 'value': value}
+            result.setdefault(name, []).append(sample)
+        return result
+
+    def prometheus(self):
+        "the Prometheus text exposition format"
+        lines = list()
+        typed = set()
+        for (name, kind, key, value) in self.collect():
+            if name not in typed:
+                lines.append('# TYPE %s %s' % (name, kind))
+                typed.add(name)
+            if kind == 'histogram':
+                for (le, n) in value.cumulative():
+                    lines.append('%s_bucket%s %d' % (name, labelText(key + (('le', le),)), n))
+                lines.append('%s_sum%s %r' % (name, labelText(key), value.sum))
+                lines.append('%s_count%s %d' % (name, labelText(key), value.count))
+            else:
+                lines.append('%s%s %r' % (name, labelText(key), float(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.metrics.prometheus()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        self.server.logger.debug(format % args)
+
+
+class MetricsServer(Thread):
+    """Serves GET /metrics on localhost until stop()."""
+    def __init__(self, metrics, port=9108, host='127.0.0.1', loggingLevel=logging.INFO):
+        Thread.__init__(self)
+        self.daemon = True
+        self.logger = logging.getLogger('[' + self.__class__.__name__ + ']')
+        if loggingLevel:
+            self.logger.setLevel(loggingLevel)
+        ch = logging.StreamHandler()
+        if loggingLevel:
+            ch.setLevel(loggingLevel)
+        formatter = logging.Formatter("%(asctime)s - %(name)s:%(levelname)s: %(message)s")
+        ch.setFormatter(formatter)
+        self.logger.addHandler(ch)
+        self.server = HTTPServer((host, port), MetricsHandler)
+        self.server.metrics = metrics
+        self.server.logger = self.logger
+        self.port = self.server.server_address[1]
+
+    def run(self):
+        self.server.serve_forever(poll_interval=1)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+#
+# Program:      $Id$
+# Description:  Every field of a CAIDA monitors.yaml, parsed once, cached on disk and indexed for lookups
+
+import os
+import socket
+import hashlib
+import marshal
+import logging
+
+CACHE_VERSION = 1
+
+def parseValue(value):
+    if value == 'true':
+        return True
+    if value == 'false':
+        return False
+    if not value or value[0] not in '+-.0123456789':
+        return value
+    for kind in (int, float):
+        try:
+            return kind(value)
+        except ValueError:
+            pass
+    return value
+
+def packAddress(ip):
+    "the packed form of an IPv4 or IPv6 address, so equal addresses match however they are written"
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            return socket.inet_pton(family, ip)
+        except (socket.error, TypeError):
+            pass
+    return None
+
+
+class Monitor(object):
+    """One monitor; fields holds every key from its monitors.yaml entry and the defaults."""
+    __slots__ = ('name', 'ip', 'ip6', 'team', 'latitude', 'longitude', 'country', 'enabled', 'capabilities', 'fields')
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+        self.ip = fields.get('ip_address')
+        self.ip6 = fields.get('ip6_address')
+        self.team = fields.get('team')
+        self.latitude = fields.get('geographic_latitude')
+        self.longitude = fields.get('geographic_longitude')
+        location = fields.get('geographic_location')
+        self.country = location.split(',')[-1].strip() if isinstance(location, str) else None
+        self.enabled = fields.get('enabled', True) is True
+        # activity_topo_v6: true -> 'topo_v6', feature_radclock: true -> 'radclock', behind_nat: true -> 'behind_nat'
+        self.capabilities = frozenset(key.split('_', 1)[1] if key.startswith(('activity_', 'feature_')) else key
+                                      for (key, value) in fields.iteritems() if value is True and key != 'enabled')
+
+    def get(self, field, default=None):
+        return self.fields.get(field, default)
+
+    def __repr__(self):
+        return 'Monitor(' + self.name + ', ' + str(self.ip) + ')'
+
+
+class MonitorRegistry(object):
+    # The parsed entries are kept in a marshal file next to monitors.yaml
+    # (or at cache_file), tagged with the source's mtime, size and SHA-1, so
+    # later processes skip parsing unless the file really changed.
+    def __init__(self, filename, cache=True, cache_file=None, loggingLevel=logging.INFO):
+        self.filename = filename
+        self.cache_file = cache_file or filename + '.cache'
+        self.logger = logging.getLogger('[' + self.__class__.__name__ + ']')
+        if loggingLevel:
+            self.logger.setLevel(loggingLevel)
+        ch = logging.StreamHandler()
+        if loggingLevel:
+            ch.setLevel(loggingLevel)
+        formatter = logging.Formatter("%(asctime)s - %(name)s:%(levelname)s: %(message)s")
+        ch.setFormatter(formatter)
+        self.logger.addHandler(ch)
+
+        entries = None
+        if cache:
+            entries = self.loadCache()
+        if entries is None:
+            entries = self.parse(filename)
+            if cache:
+                self.saveCache(entries)
+        self.index(entries)
+
+    @staticmethod
+    def parse(filename):
+        "[(monitor name, {field: value})], each monitor's fields starting from the .defaults entry"
+        defaults = dict()
+        entries = list()
+        (name, fields) = (None, None)
+        f = open(filename, 'r')
+        for line in f:
+            if line.startswith('#') or ':' not in line:
+                continue
+            (key, value) = line.split(':', 1)
+            (key, value) = (key.strip(), value.strip())
+            if key == '.defaults':
+                (name, fields) = (None, defaults)
+            elif key == '.monitor':
+                (name, fields) = (value, dict())
+                entries.append((name, fields))
+            elif fields is not None:
+                fields[key] = parseValue(value)
+        f.close()
+        result = list()
+        for (name, fields) in entries:
+            merged = dict(defaults)
+            merged.update(fields)
+            result.append((name, merged))
+        return result
+
+    def sourceKey(self):
+        st = os.stat(self.filename)
+        return (int(st.st_mtime), st.st_size)
+
+    def sourceHash(self):
+        f = open(self.filename, 'rb')
+        digest = hashlib.sha1(f.read()).hexdigest()
+        f.close()
+        return digest
+
+    def loadCache(self):
+        try:
+            f = open(self.cache_file, 'rb')
+            try:
+                cached = marshal.load(f)
+            finally:
+                f.close()
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+        if not isinstance(cached, dict) or cached.get('version') != CACHE_VERSION:
+            return None
+        if tuple(cached['key']) != self.sourceKey():
+            # touched but maybe not changed
+            if cached['sha1'] != self.sourceHash():
+                return None
+            self.saveCache(cached['entries'])
+        self.logger.debug("Loaded " + str(len(cached['entries'])) + " monitors from " + self.cache_file)
+        return cached['entries']
+
+    def saveCache(self, entries):
+        cached = {'version': CACHE_VERSION, 'key': self.sourceKey(), 'sha1': self.sourceHash(), 'entries': entries}
+        tmpname = self.cache_file + '.tmp.' + str(os.getpid())
+        try:
+            f = open(tmpname, 'wb')
+            marshal.dump(cached, f)
+            f.close()
+            os.rename(tmpname, self.cache_file)
+        except (IOError, OSError) as ex:
+            self.logger.debug("Not caching monitors: " + str(ex))
+
+    def index(self, entries):
+        self.monitors = [Monitor(name, fields) for (name, fields) in entries]
+        self.byName = dict()
+        self.byAddress = dict()
+        self.byTeam = dict()
+        self.byCountry = dict()
+        self.byCapability = dict()
+        for mon in self.monitors:
+            self.byName[mon.name] = mon
+            for ip in (mon.ip, mon.ip6):
+                if ip:
+                    self.byAddress[packAddress(ip)] = mon
+            self.byTeam.setdefault(mon.team, []).append(mon)
+            self.byCountry.setdefault(mon.country, []).append(mon)
+            for capability in mon.capabilities:
+                self.byCapability.setdefault(capability, []).append(mon)
+
+    def __iter__(self):
+        return iter(self.monitors)
+
+    def __contains__(self, name):
+        return name in self.byName
+
+    def __getitem__(self, name):
+        return self.byName[name]
+
+    def get(self, name):
+        return self.byName.get(name)
+
+    def names(self, include_disabled=False):
+        return [mon.name for mon in self.monitors if mon.enabled or include_disabled]
+
+    def getByAddress(self, ip):
+        "the monitor with this IPv4 or IPv6 address, or None"
+        return self.byAddress.get(packAddress(ip))
+
+    def getByTeam(self, team):
+        return list(self.byTeam.get(parseValue(str(team)), []))
+
+    def getByCountry(self, country):
+        return list(self.byCountry.get(country.upper(), []))
+
+    def getCapable(self, capability):
+        "monitors with e.g. 'topo_v6', 'spoofer', 'midar' or 'radclock'"
+        return list(self.byCapability.get(capability, []))
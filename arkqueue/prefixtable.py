@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+#
+# Program:      $Id$
+# Description:  Offline longest-prefix-match table built from a prefix-to-AS dump, usable
+#               in place of the BGP daemon as a ToD.hopASN resolver
+
+import bz2
+import gzip
+import bisect
+import numpy as np
+
+from bgpquery import addrToNum
+from socket import AF_INET, AF_INET6
+
+
+class PrefixTable:
+    # Nested prefixes are flattened into disjoint intervals: starts[i] is the
+    # first address of interval i and owners[i] the index into self.prefixes
+    # of its most specific covering prefix (-1 if none). A lookup is a single
+    # bisect, or one numpy searchsorted for a whole array of IPv4 addresses.
+    def __init__(self, filename=None):
+        self.prefixes = list()      # (ip, mask, asn) exactly as BGPquery.lookup returns them
+        self.pending = {AF_INET: [], AF_INET6: []}
+        self.build()
+        if filename:
+            self.load(filename)
+
+    # Accepts CAIDA prefix2as ("1.0.0.0<tab>24<tab>13335") as well as
+    # "prefix/len asn" lines; '#' starts a comment.
+    def load(self, filename):
+        if filename.endswith('.gz'):
+            f = gzip.open(filename, 'rb')
+        elif filename.endswith('.bz2'):
+            f = bz2.BZ2File(filename, 'rb')
+        else:
+            f = open(filename, 'r')
+        for line in f:
+            fields = line.split('#')[0].split()
+            if len(fields) == 3:
+                (ip, mask, asn) = fields
+            elif len(fields) == 2 and fields[0].find('/') != -1:
+                (ip, mask) = fields[0].split('/')
+                asn = fields[1]
+            else:
+                continue
+            self.add(ip, mask, asn)
+        f.close()
+        self.build()
+
+    def add(self, ip, mask, asn):
+        addr = addrToNum(ip)
+        if addr is None:
+            return
+        (family, bits, num) = addr
+        masklen = int(mask)
+        start = (num >> (bits - masklen)) << (bits - masklen)
+        end = start + (1 << (bits - masklen)) - 1
+        self.pending[family].append((start, -end, len(self.prefixes)))
+        self.prefixes.append((ip, str(masklen), asn))
+
+    def build(self):
+        (starts, owners) = self.flatten(self.pending[AF_INET], 1 << 32)
+        self.starts4 = np.array(starts, dtype=np.int64)
+        self.owners4 = np.array(owners, dtype=np.int64)
+        (self.starts6, self.owners6) = self.flatten(self.pending[AF_INET6], 1 << 128)
+
+    @staticmethod
+    def flatten(intervals, space):
+        starts = [0]
+        owners = [-1]
+        def emit(pos, owner):
+            if pos >= space:
+                return
+            if starts[-1] == pos:
+                owners[-1] = owner
+            elif owners[-1] != owner:
+                starts.append(pos)
+                owners.append(owner)
+        stack = list()      # (end, owner) of prefixes enclosing the current position
+        intervals.sort()    # by start, enclosing prefixes first
+        for (start, negend, owner) in intervals:
+            while stack and stack[-1][0] < start:
+                end = stack.pop()[0]
+                emit(end + 1, stack[-1][1] if stack else -1)
+            emit(start, owner)
+            stack.append((-negend, owner))
+        while stack:
+            end = stack.pop()[0]
+            emit(end + 1, stack[-1][1] if stack else -1)
+        return (starts, owners)
+
+    def __len__(self):
+        return len(self.prefixes)
+
+    def lookup(self, ip):
+        addr = addrToNum(ip)
+        if addr is None:
+            return (0, 0, 0)
+        (family, bits, num) = addr
+        if family == AF_INET:
+            owner = self.owners4[np.searchsorted(self.starts4, num, side='right') - 1]
+        else:
+            owner = self.owners6[bisect.bisect_right(self.starts6, num) - 1]
+        if owner < 0:
+            return (0, 0, 0)
+        return self.prefixes[owner]
+
+    def lookupMany(self, ips):
+        results = [(0, 0, 0)] * len(ips)
+        index4 = list()
+        nums4 = list()
+        for i in range(len(ips)):
+            addr = addrToNum(ips[i])
+            if addr is None:
+                continue
+            if addr[0] == AF_INET:
+                index4.append(i)
+                nums4.append(addr[2])
+            else:
+                results[i] = self.lookup(ips[i])
+        owners = self.lookupV4(np.array(nums4, dtype=np.int64))
+        for (i, owner) in zip(index4, owners):
+            if owner >= 0:
+                results[i] = self.prefixes[owner]
+        return results
+
+    def lookupV4(self, nums):
+        "map an array of IPv4 addresses as integers to indices into self.prefixes (-1 if unrouted)"
+        nums = np.asarray(nums, dtype=np.int64)
+        return self.owners4[np.searchsorted(self.starts4, nums, side='right') - 1]
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+#
+# Program:      $Id$
+# Description:  Buffered, compressed, rotating writer for finished traces that pushes back on dispatch when behind
+
+import gzip
+import time
+import struct
+import socket
+import Queue
+import logging
+from threading import Thread
+from threading import Event
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+BINARY_MAGIC = 'ARKB1\n'
+
+def packAddr(ip):
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            packed = socket.inet_pton(family, ip)
+        except socket.error:
+            continue
+        return chr(len(packed)) + packed
+    return chr(0)
+
+# Binary records: 'T' + uint32 body length + body for a parsed trace, or 'R' +
+# uint32 length + the raw line for anything that does not parse. A trace body
+# is reqid, ts (uint32), rtt (float32), dstreached (uint8), haltreason (char),
+# vp name (uint8 length + bytes), src, dst, uint16 hop count, then per hop the
+# address, rtt (float32, NaN if no reply) and tries (uint8). Addresses are a
+# length byte (0, 4 or 16) followed by the packed address.
+def packTrace(out, vp):
+    fields = out.strip().split(None, 16)
+    try:
+        body = [struct.pack('<IIfB', int(fields[0]), int(fields[8]), float(fields[10]), fields[9] == 'R'),
+                fields[13][0], chr(len(vp)), vp, packAddr(fields[4]), packAddr(fields[5])]
+        hops = fields[16].split() if len(fields) > 16 else []
+        body.append(struct.pack('<H', len(hops)))
+        for hop in hops:
+            if hop[0] == 'q':
+                body.append(chr(0) + struct.pack('<fB', float('nan'), 0))
+                continue
+            (ip, rtt, tries) = hop.split(";")[0].split(",")
+            body.append(packAddr(ip) + struct.pack('<fB', float(rtt), min(int(tries), 255)))
+    except (IndexError, ValueError, struct.error):
+        return 'R' + struct.pack('<I', len(out)) + out
+    body = ''.join(body)
+    return 'T' + struct.pack('<I', len(body)) + body
+
+def readBinary(f):
+    "yield (reqid, vp, src, dst, ts, dstreached, rtt, haltreason, [(ip, rtt, tries), ...]) or the raw line"
+    if f.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+        raise ValueError("not an arkqueue binary result file")
+    while True:
+        header = f.read(5)
+        if len(header) < 5:
+            return
+        (kind, length) = (header[0], struct.unpack('<I', header[1:])[0])
+        body = f.read(length)
+        if kind == 'R':
+            yield body
+            continue
+        (reqid, ts, rtt, dstreached) = struct.unpack_from('<IIfB', body, 0)
+        pos = struct.calcsize('<IIfB')
+        haltreason = body[pos]
+        vplen = ord(body[pos+1])
+        vp = body[pos+2:pos+2+vplen]
+        pos += 2 + vplen
+        def addr(pos):
+            n = ord(body[pos])
+            if n == 0:
+                return ('0.0.0.0', pos + 1)
+            return (socket.inet_ntop(socket.AF_INET if n == 4 else socket.AF_INET6, body[pos+1:pos+1+n]), pos + 1 + n)
+        (src, pos) = addr(pos)
+        (dst, pos) = addr(pos)
+        (nhops,) = struct.unpack_from('<H', body, pos)
+        pos += 2
+        hops = list()
+        for i in range(nhops):
+            (ip, pos) = addr(pos)
+            (hoprtt, tries) = struct.unpack_from('<fB', body, pos)
+            pos += 5
+            hops.append((ip, hoprtt, tries))
+        yield (reqid, vp, src, dst, ts, bool(dstreached), rtt, haltreason, hops)
+
+
+class ResultSink(Thread):
+    # Finished traces wait in a bounded queue and are written max_batch at a
+    # time. Past high_water queued results the gate Event is cleared; ArkVPs
+    # stop submitting new probes until the writer drains to low_water and
+    # calls resume_hook, so a slow disk throttles probing instead of memory.
+    def __init__(self, prefix, format='text', compression='gzip', maxsize=100000, high_water=None, low_water=None,
+                 max_batch=5000, rotate_bytes=None, rotate_seconds=None, resume_hook=None, loggingLevel=logging.INFO):
+        Thread.__init__(self)
+        self.daemon = True
+        if format not in ('text', 'binary'):
+            raise ValueError("format must be 'text' or 'binary', not %r" % (format,))
+        if compression not in ('gzip', 'zstd', None):
+            raise ValueError("compression must be 'gzip', 'zstd' or None, not %r" % (compression,))
+        if compression == 'zstd' and zstandard is None:
+            raise ImportError("zstd compression requires the zstandard module")
+        self.prefix = prefix
+        self.format = format
+        self.compression = compression
+        self.queue = Queue.Queue(maxsize)
+        self.high_water = high_water or maxsize * 3 // 4
+        self.low_water = low_water or maxsize // 4
+        self.max_batch = max_batch
+        self.rotate_bytes = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+        self.resume_hook = resume_hook
+        self.gate = Event()
+        self.gate.set()
+        self.exitEvent = Event()
+        self.f = None
+        self.raw = None
+        self.files = list()
+        self.written = 0
+        self.opened = 0
+        self.results = 0
+
+        self.logger = logging.getLogger('[' + self.__class__.__name__ + ']')
+        if loggingLevel:
+            self.logger.setLevel(loggingLevel)
+        ch = logging.StreamHandler()
+        if loggingLevel:
+            ch.setLevel(loggingLevel)
+        formatter = logging.Formatter("%(asctime)s - %(name)s:%(levelname)s: %(message)s")
+        ch.setFormatter(formatter)
+        self.logger.addHandler(ch)
+
+    def put(self, out, request):
+        self.queue.put((out, request))
+        if self.gate.isSet() and self.queue.qsize() >= self.high_water:
+            self.logger.debug("Result sink behind, holding back new probes.")
+            self.gate.clear()
+
+    # Usable directly as an ArkQueue finish_hook
+    def finish_hook(self, out, request):
+        self.put(out, request)
+
+    def open(self):
+        name = self.prefix + time.strftime('.%Y%m%d-%H%M%S') + '.%04d' % len(self.files)
+        name += {'text': '.txt', 'binary': '.bin'}[self.format]
+        name += {'gzip': '.gz', 'zstd': '.zst', None: ''}[self.compression]
+        if self.compression == 'gzip':
+            self.f = gzip.open(name, 'wb')
+        elif self.compression == 'zstd':
+            self.raw = open(name, 'wb')
+            self.f = zstandard.ZstdCompressor().stream_writer(self.raw)
+        else:
+            self.f = open(name, 'wb')
+        if self.format == 'binary':
+            self.f.write(BINARY_MAGIC)
+        self.files.append(name)
+        self.written = 0
+        self.opened = time.time()
+        self.logger.debug("Writing results to " + name)
+
+    def close_file(self):
+        if self.f:
+            self.f.close()
+            if self.raw:
+                self.raw.close()
+            (self.f, self.raw) = (None, None)
+
+    def write(self, batch):
+        if self.f and ((self.rotate_bytes and self.written >= self.rotate_bytes) or
+                       (self.rotate_seconds and time.time() - self.opened >= self.rotate_seconds)):
+            self.close_file()
+        if not self.f:
+            self.open()
+        if self.format == 'binary':
+            data = ''.join([packTrace(out, request[0]) for (out, request) in batch])
+        else:
+            data = ''.join([out if out.endswith('\n') else out + '\n' for (out, request) in batch])
+        self.f.write(data)
+        self.written += len(data)
+        self.results += len(batch)
+
+    def run(self):
+        while not (self.exitEvent.isSet() and self.queue.empty()):
+            try:
+                batch = [self.queue.get(timeout=1)]
+            except Queue.Empty:
+                continue
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            self.write(batch)
+            if not self.gate.isSet() and self.queue.qsize() <= self.low_water:
+                self.logger.debug("Result sink caught up, resuming probing.")
+                self.gate.set()
+                if self.resume_hook:
+                    self.resume_hook()
+        self.close_file()
+
+    def close(self):
+        self.exitEvent.set()
+        self.gate.set()
+        if self.is_alive():
+            self.join()
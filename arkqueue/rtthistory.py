@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+#
+# Program:      $Id$
+# Description:  Bounded probe completion time history and streaming percentiles
+
+import math
+import numpy as np
+
+
+class RTTHistory(object):
+    # Fixed-capacity ring of the last `capacity` completion times. Alongside
+    # each sample the ring holds the running total of everything appended so
+    # far, so the mean of the last w samples is one subtraction.
+    def __init__(self, capacity=10080):
+        self.capacity = max(int(capacity), 1)
+        self.rtts = np.zeros(self.capacity, dtype=np.float64)
+        self.sums = np.zeros(self.capacity + 1, dtype=np.float64)   # running total before/after each slot
+        self.total = 0.0
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, rtt):
+        self.rtts[self.count % self.capacity] = rtt
+        self.total += rtt
+        self.count += 1
+        self.sums[self.count % (self.capacity + 1)] = self.total
+
+    def last(self, window=1):
+        "the last `window` samples, oldest first"
+        window = max(min(window, len(self)), 0)
+        end = self.count % self.capacity
+        if window <= end:
+            return self.rtts[end-window:end]
+        return np.concatenate((self.rtts[self.capacity-(window-end):], self.rtts[:end]))
+
+    def mean(self, window=1):
+        "same result as averaging the last window samples; 0 when empty"
+        window = max(min(window, len(self)), 1)
+        if self.count == 0:
+            return 0
+        before = self.sums[(self.count - window) % (self.capacity + 1)]
+        return (self.total - before) / window
+
+
+class RTTSketch(object):
+    # Log-bucketed histogram (as in DDSketch): any percentile is returned to
+    # within relative_accuracy, memory is a fixed few hundred counters, and
+    # sketches merge by adding counts.
+    def __init__(self, relative_accuracy=0.01, min_rtt=0.001, max_rtt=7*86400):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.min_rtt = min_rtt
+        self.counts = np.zeros(int(math.ceil(math.log(max_rtt / min_rtt) / self.log_gamma)) + 2, dtype=np.int64)
+        self.count = 0
+
+    def add(self, rtt):
+        if rtt <= self.min_rtt:
+            bucket = 0
+        else:
+            bucket = min(int(math.ceil(math.log(rtt / self.min_rtt) / self.log_gamma)), len(self.counts) - 1)
+        self.counts[bucket] += 1
+        self.count += 1
+
+    def merge(self, other):
+        self.counts += other.counts
+        self.count += other.count
+        return self
+
+    def percentile(self, q):
+        if self.count == 0:
+            return 0
+        rank = int(q / 100.0 * (self.count - 1))
+        bucket = int(np.searchsorted(np.cumsum(self.counts), rank + 1))
+        if bucket == 0:
+            return self.min_rtt
+        return self.min_rtt * 2 * self.gamma ** bucket / (self.gamma + 1)
+
+    def percentiles(self, qs=(50, 95, 99)):
+        return [self.percentile(q) for q in qs]
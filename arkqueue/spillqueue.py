@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+#
+# Program:      $Id$
+# Description:  Priority queue that keeps a bounded heap in memory and spills the rest to sorted runs on disk
+
+import os
+import heapq
+import marshal
+import shutil
+import tempfile
+import collections
+import Queue
+
+
+class SpillRun(object):
+    """A file of items in sorted order, read back block items at a time; the file is open only while a block is read."""
+    def __init__(self, path, count, block=1000):
+        self.path = path
+        self.count = count
+        self.block = block
+        self.offset = 0
+        self.buffer = collections.deque()
+        self.fill()
+
+    def fill(self):
+        f = open(self.path, 'rb')
+        f.seek(self.offset)
+        for i in xrange(min(self.block, self.count - len(self.buffer))):
+            self.buffer.append(marshal.load(f))
+        self.offset = f.tell()
+        f.close()
+        self.head = self.buffer[0] if self.buffer else None
+
+    def pop(self):
+        item = self.buffer.popleft()
+        self.count -= 1
+        if self.buffer:
+            self.head = self.buffer[0]
+        elif self.count > 0:
+            self.fill()
+        else:
+            self.head = None
+        return item
+
+    def close(self):
+        os.remove(self.path)
+
+
+class SpillQueue(Queue.Queue):
+    # Same ordering as Queue.PriorityQueue: get() returns the smallest
+    # [priority, ...] item. Items must be marshal-able (lists of ints and
+    # strings, as ArkQueue and ArkVP queue). Once the heap holds more than
+    # memory_items, its larger half is sorted and written out as one run per
+    # priority level; get() then takes the smallest of the heap top and the
+    # run heads. Runs of a level are merged by size tier: once fanout runs
+    # are of similar size (within a factor of fanout) they become one, so
+    # each item is rewritten O(log N) times rather than on every spill. If a
+    # level still has max_runs runs, its fanout smallest are merged as well.
+    # Each run keeps only its next read_items items in memory and no open
+    # file, so a process can hold many SpillQueues (one per ArkVP).
+    def __init__(self, maxsize=0, memory_items=100000, spill_dir=None, max_runs=16, fanout=4, read_items=1000):
+        self.memory_items = max(memory_items, 2)
+        self.spill_dir = spill_dir
+        self.max_runs = max_runs
+        self.fanout = max(fanout, 2)
+        self.read_items = max(read_items, 1)
+        Queue.Queue.__init__(self, maxsize)
+
+    def _init(self, maxsize):
+        self.queue = []
+        self.runs = []          # heap of (head item, sequence, SpillRun)
+        self.levels = dict()    # priority -> its SpillRuns
+        self.spilled = 0
+        self.sequence = 0
+        self.directory = None
+
+    def _qsize(self, len=len):
+        return len(self.queue) + self.spilled
+
+    def _put(self, item, heappush=heapq.heappush):
+        heappush(self.queue, item)
+        if len(self.queue) > self.memory_items:
+            self.spill()
+
+    def _get(self, heappop=heapq.heappop):
+        if self.runs and (not self.queue or self.runs[0][0] < self.queue[0]):
+            (head, sequence, run) = self.runs[0]
+            item = run.pop()
+            self.spilled -= 1
+            if run.head is None:
+                heappop(self.runs)
+                self.levels[item[0]].remove(run)
+                run.close()
+            else:
+                heapq.heapreplace(self.runs, (run.head, sequence, run))
+            return item
+        return heappop(self.queue)
+
+    def write(self, priority, items):
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix='arkqueue-', dir=self.spill_dir)
+        self.sequence += 1
+        path = os.path.join(self.directory, '%s.%d' % (priority, self.sequence))
+        f = open(path, 'wb')
+        count = 0
+        for item in items:
+            marshal.dump(item, f)
+            count += 1
+        f.close()
+        run = SpillRun(path, count, self.read_items)
+        self.levels.setdefault(priority, []).append(run)
+        heapq.heappush(self.runs, (run.head, self.sequence, run))
+
+    def spill(self):
+        items = sorted(self.queue)
+        keep = self.memory_items // 2
+        (self.queue, spill) = (items[:keep], items[keep:])     # a sorted list is a heap
+        start = 0
+        while start < len(spill):
+            priority = spill[start][0]
+            end = start
+            while end < len(spill) and spill[end][0] == priority:
+                end += 1
+            self.write(priority, spill[start:end])
+            self.spilled += end - start
+            self.compact(priority)
+            start = end
+
+    def tier(self, run):
+        "0 for a run of up to fanout spills' worth of items, 1 for up to fanout**2, ..."
+        (tier, size) = (0, max(self.memory_items // 2, 1) * self.fanout)
+        while run.count >= size:
+            (tier, size) = (tier + 1, size * self.fanout)
+        return tier
+
+    def compact(self, priority):
+        while True:
+            tiers = dict()
+            for run in self.levels[priority]:
+                tiers.setdefault(self.tier(run), []).append(run)
+            full = [runs for (tier, runs) in sorted(tiers.iteritems()) if len(runs) >= self.fanout]
+            if full:
+                self.merge(priority, full[0])
+            elif len(self.levels[priority]) >= self.max_runs:
+                self.merge(priority, sorted(self.levels[priority], key=lambda run: run.count)[:self.fanout])
+            else:
+                return
+
+    def merge(self, priority, runs):
+        self.levels[priority] = [run for run in self.levels[priority] if run not in runs]
+        self.runs = [entry for entry in self.runs if entry[2] not in runs]
+        heapq.heapify(self.runs)
+        def drain(run):
+            while run.head is not None:
+                yield run.pop()
+        self.write(priority, heapq.merge(*[drain(run) for run in runs]))
+        for run in runs:
+            run.close()
+
+    def close(self):
+        "discard everything queued and remove the spill files"
+        with self.mutex:
+            for (head, sequence, run) in self.runs:
+                run.close()
+            if self.directory:
+                shutil.rmtree(self.directory, ignore_errors=True)
+            self._init(self.maxsize)
@@ -4,50 +4,209 @@
 # Author:       Robert Beverly <rbeverly@nps.edu>
 # Description:  General class for processing topology on demand traces
 
+import threading
+from array import array
+
 import bgpquery
+import editdistance
+
+# Hop addresses are interned so traces share one copy of each address
+# string and store their path as an array of integer ids. Id 0 is always
+# '0.0.0.0'; unresponsive ('q') hops are stored as UNRESPONSIVE.
+UNRESPONSIVE = -1
+
+class AddressTable(object):
+    # A table only grows. Each ToD keeps a reference to the table it was
+    # parsed with, so a long-running process should call resetAddresses()
+    # now and then (e.g. after each batch of results is analysed), or give
+    # ToD its own table per batch; the old table is freed with its traces.
+    def __init__(self):
+        self.addresses = ['0.0.0.0']
+        self.ids = {'0.0.0.0': 0}
+        self.lock = threading.Lock()
+
+    def intern(self, ip):
+        return self.internAll((ip,))[0]
+
+    def internAll(self, ips):
+        "ids of a sequence of addresses, taking the lock once for all the new ones"
+        ids = self.ids
+        new = [ip for ip in ips if ip not in ids]
+        if new:
+            with self.lock:
+                for ip in new:
+                    if ip not in ids:
+                        ids[ip] = len(self.addresses)
+                        self.addresses.append(ip)
+        return [ids[ip] for ip in ips]
+
+    def addressOf(self, hopid):
+        if hopid == UNRESPONSIVE:
+            return '0.0.0.0'
+        return self.addresses[hopid]
+
+    def __len__(self):
+        return len(self.addresses)
+
+_table = AddressTable()     # the default for new traces
+
+def resetAddresses():
+    "start a new default table; traces parsed before keep (and keep alive) the old one"
+    global _table
+    _table = AddressTable()
+
+def internAddress(ip):
+    return _table.intern(ip)
 
-class ToD:
-    def __init__(self, line):
+def addressOf(hopid):
+    return _table.addressOf(hopid)
+
+def parseRTT(rtt):
+    try:
+        return float(rtt)
+    except ValueError:
+        return float('nan')
+
+class ToD(object):
+    # Only the header fields are split out up front; the path is parsed from
+    # self.line the first time hops, edges or vertices are needed, and again
+    # for its RTTs the first time those are.
+    __slots__ = ('line', 'reqid', 'src', 'dst', 'ts', 'dstreached', 'rtt', 'ttl', 'rttl',
+                 'haltreason', 'status', 'used', 'reached_prefix', 'ASN',
+                 '_range', '_ASNhops', '_destASNhops', '_hopids', '_rttvals', '_rttstrs', '_table',
+                 '_hops', '_rtts')
+
+    def __init__(self, line, table=None):
         self.line = line
-        self.range = [0,0]
+        self._table = table or _table
         self.used = False
         self.reached_prefix = False
         #if len(line.strip().split(None)) < 17:
         #    print line
-        try:
-            (self.reqid, tmp, tmp, tmp, self.src, self.dst,
+        (self.reqid, tmp, tmp, tmp, src, dst,
          tmp, tmp, self.ts, self.dstreached, self.rtt, self.ttl, self.rttl,
-         self.haltreason, tmp, self.status, self.path) = line.strip().split(None,16)
-        except:
-            (self.reqid, tmp, tmp, tmp, self.src, self.dst,
-         tmp, tmp, self.ts, self.dstreached, self.rtt, self.ttl, self.rttl,
-         self.haltreason, tmp, self.status) = line.strip().split(None,16)
-            self.path = ''
+         self.haltreason, tmp, self.status) = line.strip().split(None,16)[:16]
+        self.src = self._table.addresses[self._table.intern(src)]
+        self.dst = self._table.addresses[self._table.intern(dst)]
         self.ASN = 0
-        self.ASNhops = []
-        self.destASNhops = []   # Gathers interfaces that belong to
-                                # the destination ASN.
-        self.hops = []
-        self.rtts = []
-        self.edges = set()
-        for hop in self.path.split():
-            if hop[0] == 'q':
-                self.hops.append('0.0.0.0')
-                continue
-            # XXX - when do we get this behavior?
-            if hop.find(";") > -1:
-                hop = hop.split(";")[0]
-            (ip, rtt, tries) = hop.split(",")
-            #print "[tod.py] ", ip, "\trtt: ", rtt, "\ttries: ", tries
-            if len(self.hops) > 0:
-                if self.hops[-1] != '0.0.0.0':
-                    self.edges.add((self.hops[-1],ip))
-            self.hops.append(ip)
-            self.rtts.append(rtt)
+        self._range = None
+        self._ASNhops = None
+        self._destASNhops = None   # Gathers interfaces that belong to
+                                   # the destination ASN.
+        self._hopids = None
+        self._rttvals = None
+        self._rttstrs = None
+        self._hops = None
+        self._rtts = None
 
-        self.vertices = set([x for x in self.hops if x != '0.0.0.0'])
-        self.vertices.add(self.src)
+    def splitPath(self):
+        "the path's hops, and the [ip, rtt, tries] fields of the answered ones"
+        path = self.path
+        hops = path.split()
+        # XXX - when do we get this behavior?
+        if path.find(";") > -1:
+            hops = [hop.split(";")[0] for hop in hops]
+        return (hops, [hop.split(",") for hop in hops if hop[0] != 'q'])
 
+    def parse(self):
+        (hops, answered) = self.splitPath()
+        hopids = self._table.internAll([fields[0] for fields in answered])
+        if len(answered) < len(hops):
+            answer = iter(hopids).next
+            hopids = [UNRESPONSIVE if hop[0] == 'q' else answer() for hop in hops]
+        self._hopids = array('i', hopids)
+
+    def parseRTTs(self):
+        rttstrs = [fields[1] for fields in self.splitPath()[1]]
+        try:
+            rttvals = array('d', map(float, rttstrs))
+        except ValueError:
+            rttvals = array('d', [parseRTT(rtt) for rtt in rttstrs])
+        # RTT strings are rebuilt from the floats unless that would change them
+        if ['%.3f' % rtt for rtt in rttvals] != rttstrs:
+            self._rttstrs = tuple(intern(r) for r in rttstrs)
+        self._rttvals = rttvals
+
+    @property
+    def path(self):
+        fields = self.line.strip().split(None,16)
+        if len(fields) > 16:
+            return fields[16]
+        return ''
+
+    def getHopIDs(self):
+        if self._hopids is None:
+            self.parse()
+        return self._hopids
+
+    def getRTTValues(self):
+        if self._rttvals is None:
+            self.parseRTTs()
+        return self._rttvals
+
+    # hops and rtts are decoded once, on first use
+    @property
+    def hops(self):
+        if self._hops is None:
+            addresses = self._table.addresses
+            self._hops = [addresses[hopid] if hopid >= 0 else '0.0.0.0' for hopid in self.getHopIDs()]
+        return self._hops
+
+    @property
+    def rtts(self):
+        if self._rtts is None:
+            rttvals = self.getRTTValues()
+            if self._rttstrs is not None:
+                self._rtts = list(self._rttstrs)
+            else:
+                self._rtts = ['%.3f' % rtt for rtt in rttvals]
+        return self._rtts
+
+    @property
+    def edges(self):
+        edges = set()
+        last = UNRESPONSIVE
+        for hopid in self.getHopIDs():
+            if hopid != UNRESPONSIVE and last > 0:
+                edges.add((self._table.addresses[last], self._table.addresses[hopid]))
+            last = hopid
+        return edges
+
+    @property
+    def vertices(self):
+        vertices = set([self._table.addresses[hopid] for hopid in self.getHopIDs() if hopid > 0])
+        vertices.add(self.src)
+        return vertices
+
+    @property
+    def range(self):
+        if self._range is None:
+            self._range = [0,0]
+        return self._range
+
+    @range.setter
+    def range(self, value):
+        self._range = value
+
+    @property
+    def ASNhops(self):
+        if self._ASNhops is None:
+            self._ASNhops = []
+        return self._ASNhops
+
+    @ASNhops.setter
+    def ASNhops(self, value):
+        self._ASNhops = value
+
+    @property
+    def destASNhops(self):
+        if self._destASNhops is None:
+            self._destASNhops = []
+        return self._destASNhops
+
+    @destASNhops.setter
+    def destASNhops(self, value):
+        self._destASNhops = value
 
     def printSummary(self):
         print "[tod.py] Trace:", self.src, "->", self.dst, "[", self.range[0], ":", self.range[1], "]"
@@ -72,11 +231,13 @@ class ToD:
         print "[tod.py] ReqId ", self.reqid, ":    ", self.src, "->", self.dst, ", ASN:", self.ASN, 
         if start != 1 or end != 9999:
             print "range:", start, "->", end,
-        if end > len(self.hops):
-            end = len(self.hops)
+        hops = self.hops
+        rtts = self.rtts
+        if end > len(hops):
+            end = len(hops)
         print 
         for i in range(start, end + 1):
-            print("\t(Hop " + str(i) +") " + self.hops[i-1] + "\tRTT:" + self.rtts[i-1])
+            print("\t(Hop " + str(i) +") " + hops[i-1] + "\tRTT:" + rtts[i-1])
         #prints RTT to destination for completeness
         print "\t(Dest) ", self.dst, "\tRTT:", self.rtt
 
@@ -85,11 +246,13 @@ class ToD:
         #print(self.reqid + "," + self.src + "," + self.dst)
         if start != 1 or end != 9999:
             print "range:", start, "->", end,
-        if end > len(self.hops):
-            end = len(self.hops)
+        hops = self.hops
+        rtts = self.rtts
+        if end > len(hops):
+            end = len(hops)
         #print "ReqID, Hop#, Hop, RTT"
         for i in range(start, end + 1):
-            print(self.reqid + "," + str(i) + "," + self.hops[i-1] + "," + self.rtts[i-1])
+            print(self.reqid + "," + str(i) + "," + hops[i-1] + "," + rtts[i-1])
         #prints RTT to destination for completeness
         print(str(end+1) + "," + self.dst + "," + self.rtt)
             
@@ -98,10 +261,11 @@ class ToD:
                 "ASN:" + str(self.ASN) + "\n"
         if start != 1 or end != 9999:
             text = text + "range:" + str(start) + "->" + str(end) + "\n"
-        if end > len(self.hops):
-            end = len(self.hops)
+        hops = self.hops
+        if end > len(hops):
+            end = len(hops)
         for i in range(start, end + 1):
-            text = text + "\t" + str(i) + "Hop:" + str(self.hops[i-1])
+            text = text + "\t" + str(i) + "Hop:" + str(hops[i-1])
         return text
 
     #returns if dstReached status
@@ -113,11 +277,13 @@ class ToD:
         results=[]
         if start != 1 or end != 9999:
             print "range:", start, "->", end,
-        if end > len(self.hops):
-            end = len(self.hops)
+        hops = self.hops
+        rtts = self.rtts
+        if end > len(hops):
+            end = len(hops)
 
         for i in range(start, end + 1):
-            oneHopRTT=self.reqid + "," + str(i) + "," + self.hops[i-1] + "," + self.rtts[i-1]
+            oneHopRTT=self.reqid + "," + str(i) + "," + hops[i-1] + "," + rtts[i-1]
             results.append(oneHopRTT)
         #RTT to destination for completeness
         oneHopRTT = self.reqid + "," + str(end+1) + "," + self.dst + "," + self.rtt
@@ -138,7 +304,7 @@ class ToD:
         return self.rtts
 
     def getNumHops(self):
-        return len(self.hops)
+        return len(self.getHopIDs())
 
     def add(self, interface_dict):
         for hop in self.hops:
@@ -148,14 +314,22 @@ class ToD:
                 interface_dict[hop]=1
 
     def differAt(self, trace):
-        s = self.hops
-        t = trace.hops
+        if self._table is trace._table:
+            # '0.0.0.0' and unresponsive hops both become 0
+            s = [max(hopid, 0) for hopid in self.getHopIDs()]
+            t = [max(hopid, 0) for hopid in trace.getHopIDs()]
+            blank = 0
+        else:
+            # hop ids are only comparable within one AddressTable
+            s = self.hops
+            t = trace.hops
+            blank = '0.0.0.0'
         diff = []
         l = len(s)
         if (len(t) < l):
             l = len(t)
         for i in range(l):
-            if s[i] == '0.0.0.0' or t[i] == '0.0.0.0':
+            if s[i] == blank or t[i] == blank:
                 continue
             if s[i] != t[i]:
                 diff.append(i)
@@ -168,101 +342,42 @@ class ToD:
                 return True
         return False
 
-    def EDbyASN(self, t2):
+    def EDbyASN(self, t2, bound=None):
         s = []
-        for i in range(len(self.hops)):
+        hops = self.hops
+        for i in range(len(hops)):
             if self.ASNhops[i] == self.ASN:
-                s.append(self.hops[i])
+                s.append(hops[i])
         t = []
-        for i in range(len(t2.hops)):
+        hops = t2.hops
+        for i in range(len(hops)):
             if t2.ASNhops[i] == t2.ASN:
-                t.append(t2.hops[i])
-        return self.ED(s,t)
-
-    def ED(self, s, t):
-#    def ED(self, t):
-#        s = self.hops
-        m = len(s) + 1
-        n = len(t) + 1
-        d = []
- 
-        for i in range(m):
-            d.append([])
-            for j in range(n):
-                d[i].append(0)
-        
-        for i in range(m):
-            d[i][0] = i
-        for j in range(n):
-            d[0][j] = j
-
-        for j in range(1,n):
-            for i in range(1,m):
-                if s[i-1] == t[j-1]:
-                    d[i][j] = d[i-1][j-1]
-                else:
-                    r = [ d[i-1][j] + 1, d[i][j-1] + 1, d[i-1][j-1] + 1 ]
-                    d[i][j] = min(r)
-
-        #for i in range(m):
-        #    for j in range(n):
-        #        print d[i][j],
-        #    print ""
-
-        #print "Dist:", d[m-1][n-1]
-        return d[m-1][n-1]
+                t.append(hops[i])
+        return self.ED(s,t,bound=bound)
+
+    # See editdistance.distanceMatrix/distancesTo for many comparisons at once
+    def ED(self, s, t, bound=None):
+        return editdistance.levenshtein(s, t, bound=bound)
     
     # conservative ED measure
     def ED2(self, t):
-        s = self.hops
-
-        if (len(s) > len(t)):
-            tmp = s
-            s = t
-            t = tmp
-        m = len(s) + 1
-        n = len(t) + 1
-        d = []
-
-        ll = len(s)
-        if (len(t) < len(s)):
-            ll = len(t)
-
-        for i in range(m):
-            d.append([])
-            for j in range(n):
-                d[i].append(0)
-        
-        for i in range(m):
-            d[i][0] = i
-        for j in range(n):
-            d[0][j] = j
-
-        mm = 99999
-        for j in range(1,n):
-            for i in range(1,m):
-                if s[i-1] == t[j-1]:
-                    d[i][j] = 0
-                else:
-                    r = [ d[i-1][j] + 1, d[i][j-1] + 1, d[i-1][j-1] + 1 ]
-                    d[i][j] = min(r)
-            if d[m-1][j] < mm:
-                mm = d[m-1][j]
-
-        return mm
+        return editdistance.conservative(self.hops, t)
     
-    def hopASN(self):
+    # resolver is anything with lookupMany(ips) returning (ip, mask, asn) tuples;
+    # by default the shared, cached BGPclient for localhost:2000
+    def hopASN(self, resolver=None):
         min_asn_hops = 0
         dASNhops = []
         last_hop = ''
         ingress = ''
-        b = bgpquery.BGPquery("localhost", 2000)
-        b.connect()
-        (ip, mask, asn) = b.lookup(self.dst)
+        if resolver is None:
+            resolver = bgpquery.shared("localhost", 2000)
+        hops = self.hops
+        answers = resolver.lookupMany([self.dst] + hops)
+        (ip, mask, asn) = answers[0]
         self.ASN = asn
         #print asn
-        for hop in self.hops:
-            (ip, mask, asn) = b.lookup(hop)
+        for (hop, (ip, mask, asn)) in zip(hops, answers[1:]):
             self.ASNhops.append(asn)
         #    print hop, asn
             if asn == self.ASN:   # checks whether ip belongs to destination ASN
@@ -273,9 +388,8 @@ class ToD:
             last_hop = hop # holds last hop outside the dest. AS.
         l = len(dASNhops)
         if l < min_asn_hops: # at least 1 hop in dASNhops
-            xhops = self.hops[-(min_asn_hops+1)-l:-l-1]
+            xhops = hops[-(min_asn_hops+1)-l:-l-1]
             dASNhops = xhops + dASNhops
-        del b
         #print self.hops
         #print dASNhops
         return dASNhops, ingress
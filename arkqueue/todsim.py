@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+#
+# Program:      $Id$
+# Description:  Stand-in for tod-client that answers trace requests locally, for testing and load generation
+
+import os
+import sys
+import json
+import time
+import heapq
+import math
+import zlib
+import random
+import select
+import signal
+import getopt
+import collections
+
+prog = os.path.basename(__file__)
+
+DEFAULTS = {'latency': 'lognormal:1.0,0.5',    # seconds from start to answer
+            'loss': 0.0,                        # fraction of requests never answered
+            'outage': None,                     # 'MTBF,DURATION': silent periods, answers due in them are lost
+            'reached': 0.7,                     # fraction of traces that reach their destination
+            'churn': 0.05}                      # fraction of traces taking a different path than last time
+
+def parseLatency(spec):
+    "a function returning one latency draw, from lognormal:MEDIAN,SIGMA uniform:LO,HI exponential:MEAN pareto:SCALE,ALPHA or constant:S"
+    (kind, _, args) = spec.partition(':')
+    args = [float(a) for a in args.split(',') if a]
+    if kind == 'lognormal':
+        return lambda rand: rand.lognormvariate(math.log(args[0]), args[1])
+    if kind == 'uniform':
+        return lambda rand: rand.uniform(args[0], args[1])
+    if kind == 'exponential':
+        return lambda rand: rand.expovariate(1.0 / args[0])
+    if kind == 'pareto':
+        return lambda rand: args[0] * rand.paretovariate(args[1])
+    if kind == 'constant':
+        return lambda rand: args[0]
+    raise ValueError("unknown latency distribution: " + spec)
+
+def address(seed, v6=False):
+    if v6:
+        return '2001:db8:%x:%x::%x' % ((seed >> 32) & 0xffff, (seed >> 16) & 0xffff, seed & 0xffff)
+    return '%d.%d.%d.%d' % (10 + seed % 200, (seed >> 8) & 0xff, (seed >> 16) & 0xff, 1 + (seed >> 24) % 254)
+
+
+class Profile(object):
+    """How one vantage point behaves."""
+    def __init__(self, vp, options, vary=False):
+        self.vp = vp
+        self.latency = parseLatency(options['latency'])
+        self.scale = 1.0
+        if vary:
+            # a fixed spread of 0.5x to 2x across VPs, so the fleet is not uniform
+            self.scale = 2 ** ((zlib.crc32(vp) & 0xffff) / 32767.5 - 1)
+        self.loss = float(options['loss'])
+        self.reached = float(options['reached'])
+        self.churn = float(options['churn'])
+        self.outage = None
+        if options['outage']:
+            (self.mtbf, self.outage) = [float(x) for x in str(options['outage']).split(',')]
+        self.down = (0, 0)      # current or next (start, end) of an outage
+
+    def silent(self, now, rand):
+        if not self.outage:
+            return False
+        while now >= self.down[1]:
+            start = max(now, self.down[1]) + rand.expovariate(1.0 / self.mtbf)
+            self.down = (start, start + self.outage)
+        return now >= self.down[0]
+
+
+class Simulator(object):
+    # Requests beyond --concurrency wait in a FIFO, as they would at the
+    # monitor; each started request gets a completion time from its VP's
+    # latency distribution and sits in a heap until then. One process
+    # serves any number of requests with a single select() loop.
+    def __init__(self, concurrency=100, options=None, config=None, vary=False, seed=None):
+        self.concurrency = concurrency
+        self.options = dict(DEFAULTS)
+        self.options.update(options or {})
+        self.config = config or {}
+        self.vary = vary
+        self.rand = random.Random(seed)
+        self.profiles = dict()
+        self.paths = dict()             # (vp, target) -> path seed of its last trace
+        self.pending = collections.deque()
+        self.running = []               # heap of (due, reqid, vp, target, lost)
+        self.stats = collections.defaultdict(int)
+        self.cleared = False
+
+    def profile(self, vp):
+        if vp not in self.profiles:
+            options = dict(self.options)
+            options.update(self.config.get('default', {}))
+            options.update(self.config.get('vps', {}).get(vp, {}))
+            self.profiles[vp] = Profile(vp, options, self.vary)
+        return self.profiles[vp]
+
+    def request(self, line, now):
+        fields = line.split()
+        if fields == ['clear']:
+            self.clear()
+            return
+        if len(fields) < 3:
+            return
+        self.pending.append((fields[0], fields[1], fields[-1]))
+        self.stats['requests'] += 1
+        self.start(now)
+
+    def start(self, now):
+        while self.pending and len(self.running) < self.concurrency:
+            (reqid, vp, target) = self.pending.popleft()
+            prof = self.profile(vp)
+            due = now + prof.latency(self.rand) * prof.scale
+            lost = self.rand.random() < prof.loss
+            heapq.heappush(self.running, (due, reqid, vp, target, lost))
+
+    def trace(self, reqid, vp, target, now):
+        "a ToD answer line: stable per (vp, target) path, sometimes changing"
+        prof = self.profile(vp)
+        v6 = ':' in target
+        key = (vp, target)
+        if key not in self.paths or self.rand.random() < prof.churn:
+            self.paths[key] = self.rand.getrandbits(48)
+        path = random.Random(self.paths[key])
+        length = path.randint(6, 20)
+        reached = self.rand.random() < prof.reached
+        rtt = 0.0
+        hops = list()
+        for ttl in range(1, length + 1):
+            rtt += path.uniform(0.1, 8.0)
+            if path.random() < 0.08:
+                hops.append('q')
+            else:
+                # early hops belong to the VP, later ones to the path toward the target
+                seed = zlib.crc32(vp) & 0xffffffff if ttl <= 2 else path.getrandbits(40)
+                hops.append('%s,%.3f,1' % (address(seed + ttl, v6), rtt * self.rand.uniform(0.95, 1.1)))
+        if reached:
+            hops.append('%s,%.3f,1' % (target, rtt * 1.05))
+        src = address(zlib.crc32(vp) & 0xffffffff, v6)
+        return '%s %s trace T %s %s 0 0 %d %s %.3f %d %d %s 0 C %s\n' % (
+            reqid, vp, src, target, int(now), 'R' if reached else 'N', rtt * 1.05 if reached else 0,
+            len(hops), length + 1, 'S' if reached else 'G', ' '.join(hops))
+
+    def due(self, now):
+        "answer lines for every request finished by now"
+        lines = list()
+        while self.running and self.running[0][0] <= now:
+            (due, reqid, vp, target, lost) = heapq.heappop(self.running)
+            if lost:
+                self.stats['lost'] += 1
+            elif self.profile(vp).silent(due, self.rand):
+                self.stats['silenced'] += 1
+            else:
+                lines.append(self.trace(reqid, vp, target, due))
+                self.stats['answered'] += 1
+        self.start(now)
+        return lines
+
+    def clear(self):
+        "drop every pending and running request, as tod-debug --clear-requests does"
+        self.stats['cleared'] += len(self.pending) + len(self.running)
+        self.pending.clear()
+        self.running = []
+
+    def run(self, infd=0, outfd=1):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: setattr(self, 'cleared', True))
+        buf = ''
+        closed = False
+        while not closed or self.pending or self.running:
+            timeout = max(0, self.running[0][0] - time.time()) if self.running else None
+            if closed:
+                time.sleep(timeout or 0)
+                fdready = ([], [], [])
+            else:
+                try:
+                    fdready = select.select([infd], [], [], timeout)
+                except select.error as ex:
+                    if ex[0] != 4:
+                        raise
+                    fdready = ([], [], [])
+            if self.cleared:
+                self.cleared = False
+                self.clear()
+            now = time.time()
+            if fdready[0]:
+                try:
+                    data = os.read(infd, 65536)
+                except OSError as ex:
+                    if ex.errno != 4:
+                        raise
+                    continue
+                if not data:
+                    closed = True
+                lines = (buf + data).split('\n')
+                buf = lines.pop()
+                for line in lines:
+                    self.request(line, now)
+            out = ''.join(self.due(now))
+            while out:
+                try:
+                    out = out[os.write(outfd, out):]
+                except OSError as ex:
+                    if ex.errno != 4:
+                        return
+        return self.stats
+
+
+def usage(prog):
+    print "Usage:", prog, "[--session-id=ID] [--concurrency=N] [--latency=lognormal:MEDIAN,SIGMA|uniform:LO,HI|exponential:MEAN|pareto:SCALE,ALPHA|constant:S]"
+    print "      [--loss=P] [--outage=MTBF,DURATION] [--reached=P] [--churn=P] [--vary] [--seed=N] [--config=FILE.json]"
+    print "Reads 'reqid vp trace target' lines on stdin and writes ToD trace lines to stdout; a 'clear' line or SIGUSR1 clears all requests."
+    sys.exit(-1)
+
+def main():
+    # until run() handles it, a SIGUSR1 (with nothing read yet to clear) must not kill us
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "h", ["help", "session-id=", "concurrency=", "latency=", "loss=", "outage=", "reached=", "churn=", "vary", "seed=", "config="])
+    except getopt.GetoptError, err:
+        usage(prog)
+
+    (concurrency, options, config, vary, seed) = (100, dict(), None, False, None)
+    for o, a in opts:
+        if o == "--concurrency":
+            concurrency = int(a)
+        elif o in ("--latency", "--loss", "--outage", "--reached", "--churn"):
+            options[o[2:]] = a
+        elif o == "--vary":
+            vary = True
+        elif o == "--seed":
+            seed = int(a)
+        elif o == "--config":
+            f = open(a)
+            config = json.load(f)
+            f.close()
+        elif o in ("-h", "--help"):
+            usage(prog)
+    Simulator(concurrency, options, config, vary, seed).run()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+#
+# Program:      $Id$
+# Description:  Columnar parser for streams of tod-client output lines
+
+import gzip
+import socket
+import struct
+from array import array
+import numpy as np
+
+from tod import ToD
+
+
+class TraceBatch:
+    # Per-trace columns (one entry per trace):
+    #   reqid, ts (int64), src, dst (address ids), src_ip, dst_ip (IPv4 as
+    #   int64, -1 for IPv6), dstreached (bool), rtt (float64), haltreason (S1),
+    #   hop_start (int64, n+1 offsets of each trace's rows in the hop table)
+    # Hop table (one row per hop, unresponsive hops included as 0.0.0.0):
+    #   hop_trace, hop_num, hop_addr, hop_ip, hop_rtt (nan if no reply), hop_tries
+    # Addresses are interned once in self.addresses; *_addr columns index it.
+    # extend() only appends to array.array buffers; the numpy columns, and
+    # the IPv4 value of each new address, are built on first access afterwards.
+    derived = ('addr_ip', 'src_ip', 'dst_ip', 'hop_ip')
+    dtypes = {'l': np.int64, 'h': np.int16, 'b': np.int8, 'd': np.float64, 'c': 'S1'}
+
+    def __init__(self, source=None, keep_lines=True):
+        self.keep_lines = keep_lines
+        self.addresses = list()
+        self.address_ids = dict()
+        self.address_ips = array('l')
+        self.address_ids['q'] = self.intern('0.0.0.0')     # how unresponsive hops are stored
+        self.errors = 0
+        self.text = list()
+        self.cols = dict((name, array(code)) for (name, code) in
+            [('reqid', 'l'), ('ts', 'l'), ('src', 'l'), ('dst', 'l'), ('dstreached', 'b'), ('rtt', 'd'),
+             ('haltreason', 'c'), ('hop_start', 'l'), ('line_start', 'l'),
+             ('hop_trace', 'l'), ('hop_num', 'h'), ('hop_addr', 'l'), ('hop_rtt', 'd'), ('hop_tries', 'h')])
+        self.cols['hop_start'].append(0)
+        self.cols['line_start'].append(0)
+        if source is not None:
+            self.extend(source)
+
+    def intern(self, addr):
+        try:
+            return self.address_ids[addr]
+        except KeyError:
+            self.address_ids[addr] = len(self.addresses)
+            self.addresses.append(addr)
+            return self.address_ids[addr]
+
+    # source is a filename (optionally .gz) or any iterable of tod-client lines
+    def extend(self, source, chunk=10000):
+        if isinstance(source, basestring):
+            if source.endswith('.gz'):
+                f = gzip.open(source, 'rb')
+            else:
+                f = open(source, 'r')
+            self.extend(f)
+            f.close()
+            return self
+        # Lines are split once and their values collected in lists, which go
+        # into the array.array columns chunk lines at a time.
+        # Addresses are interned then too.
+        c = self.cols
+        keep_lines = self.keep_lines
+        add_text = self.text.append
+        pending = dict((name, list()) for name in c)
+        pending_reqid = pending['reqid']
+        (add_hop_addr, add_hop_rtt, add_hop_tries) = (pending['hop_addr'].extend, pending['hop_rtt'].extend, pending['hop_tries'].extend)
+        (add_reqid, add_ts, add_src, add_dst) = (pending['reqid'].append, pending['ts'].append, pending['src'].append, pending['dst'].append)
+        (add_dstreached, add_rtt, add_haltreason) = (pending['dstreached'].append, pending['rtt'].append, pending['haltreason'].append)
+        (add_hop_start, add_line_start) = (pending['hop_start'].append, pending['line_start'].append)
+        (nhops, offset) = (c['hop_start'][-1], c['line_start'][-1])
+        for line in source:
+            fields = line.split(None, 16)
+            if len(fields) < 16:
+                self.errors += 1
+                continue
+            try:
+                (reqid, ts, rtt) = (int(fields[0]), int(fields[8]), float(fields[10]))
+                hops = hopips = hoprtts = hoptries = []
+                if len(fields) == 17:
+                    path = fields[16]
+                    hops = path.split()
+                    if path.find(";") > -1:
+                        hops = [hop.split(";")[0] for hop in hops]
+                    # one 'ip rtt tries' triple per hop, so each column is a slice
+                    if path.find("q") > -1:
+                        hops = [hop if hop[0] != 'q' else 'q,nan,0' for hop in hops]
+                    parts = ' '.join(hops).replace(',', ' ').split()
+                    if len(parts) != 3 * len(hops):
+                        raise ValueError(path)
+                    hopips = parts[0::3]            # 'q' interns as 0.0.0.0
+                    hoprtts = map(float, parts[1::3])
+                    hoptries = parts[2::3]      # converted a chunk at a time by flush()
+                    if not ''.join(hoptries).isdigit():
+                        hoptries = [str(int(tries)) for tries in hoptries]
+            except ValueError:
+                self.errors += 1
+                continue
+            add_hop_addr(hopips)
+            add_hop_rtt(hoprtts)
+            add_hop_tries(hoptries)
+            add_reqid(reqid)
+            add_ts(ts)
+            add_src(fields[4])
+            add_dst(fields[5])
+            add_dstreached(fields[9] == 'R')
+            add_rtt(rtt)
+            add_haltreason(fields[13][0])
+            nhops += len(hops)
+            add_hop_start(nhops)
+            if keep_lines:
+                if not line.endswith('\n'):
+                    line += '\n'
+                add_text(line)
+                offset += len(line)
+                add_line_start(offset)
+            if len(pending_reqid) >= chunk:
+                self.flush(pending)
+        self.flush(pending)
+        # drop the numpy snapshot; it is rebuilt on first use, not on every extend()
+        for name in self.cols.keys() + list(self.derived):
+            self.__dict__.pop(name, None)
+        return self
+
+    # Move what extend() collected into the columns. Addresses arrive as
+    # strings, hop_tries as digit strings, and hop_trace and hop_num follow
+    # from hop_start.
+    def flush(self, pending):
+        c = self.cols
+        (ids, addresses) = (self.address_ids, self.addresses)
+        for name in ('src', 'dst', 'hop_addr'):
+            new = list(set(pending[name]).difference(ids))
+            ids.update(zip(new, xrange(len(addresses), len(addresses) + len(new))))
+            addresses.extend(new)
+            pending[name][:] = map(ids.__getitem__, pending[name])
+        starts = np.array([c['hop_start'][-1]] + pending['hop_start'], dtype=np.int64)
+        counts = np.diff(starts)
+        first = len(c['reqid'])
+        c['hop_trace'].fromstring(np.repeat(np.arange(first, first + len(counts), dtype=np.int64), counts).tostring())
+        c['hop_num'].fromstring((np.arange(starts[0], starts[-1]) - np.repeat(starts[:-1], counts) + 1).astype(np.int16).tostring())
+        if pending['hop_tries']:
+            c['hop_tries'].fromstring(np.fromstring(' '.join(pending['hop_tries']), dtype=np.int16, sep=' ').tostring())
+        for (name, values) in pending.iteritems():
+            if name not in ('hop_trace', 'hop_num', 'hop_tries'):
+                c[name].extend(values)
+            del values[:]
+
+    def __getattr__(self, name):
+        if name in self.derived or name in self.__dict__.get('cols', ()):
+            self.build()
+            return self.__dict__[name]
+        raise AttributeError(name)
+
+    # Snapshot the accumulated columns as numpy arrays; arrays are copied
+    # because the array.array buffers move as later extend() calls grow them.
+    def build(self):
+        for (name, col) in self.cols.items():
+            setattr(self, name, np.frombuffer(col.tostring(), dtype=self.dtypes[col.typecode]))
+        self.dstreached = self.dstreached.astype(bool)
+        self.address_ips.extend(self.addrsToIPs(self.addresses[len(self.address_ips):]))
+        self.addr_ip = np.frombuffer(self.address_ips.tostring(), dtype=np.int64)
+        self.src_ip = self.addr_ip[self.src]
+        self.dst_ip = self.addr_ip[self.dst]
+        self.hop_ip = self.addr_ip[self.hop_addr]
+        if self.keep_lines and len(self.text) > 1:
+            self.text = [''.join(self.text)]
+
+    @staticmethod
+    def dottedQuads(text):
+        "whether every address in this space-separated (and -terminated) list is four dot-separated decimal numbers"
+        if not text.replace('.', '').replace(' ', '').isdigit() or text[0] == '.':
+            return False
+        if text.find('..') > -1 or text.find(' .') > -1 or text.find('. ') > -1:
+            return False
+        chars = np.frombuffer(text, dtype=np.uint8)
+        (dot, space) = (chars == ord('.'), chars == ord(' '))
+        digits = ~(dot | space)
+        # A leading zero makes inet_aton read the octet as octal.
+        if (~digits[:-2] & (chars[1:-1] == ord('0')) & digits[2:]).any() or (text[0] == '0' and digits[1]):
+            return False
+        dots = np.cumsum(dot)[space]
+        return bool((np.diff(dots, prepend=0) == 3).all())
+
+    @staticmethod
+    def addrsToIPs(addrs):
+        "addrToIP of each address, with well-formed dotted quads converted all at once"
+        text = ' '.join(addrs) + ' '
+        if TraceBatch.dottedQuads(text):
+            octets = np.fromstring(text.replace('.', ' '), dtype=np.int64, sep=' ').reshape(-1, 4)
+            ips = octets.dot([1 << 24, 1 << 16, 1 << 8, 1])
+            ips[(octets > 255).any(axis=1)] = -1
+            return ips
+        return np.array(map(TraceBatch.addrToIP, addrs), dtype=np.int64)
+
+    @staticmethod
+    def addrToIP(addr):
+        try:
+            return struct.unpack('!I', socket.inet_aton(addr))[0] if addr.count('.') == 3 else -1
+        except socket.error:
+            return -1
+
+    def __len__(self):
+        return len(self.cols['reqid'])
+
+    def numHops(self):
+        return np.diff(self.hop_start)
+
+    def hopRows(self, i):
+        return slice(self.hop_start[i], self.hop_start[i+1])
+
+    def getDst(self, i):
+        return self.addresses[self.dst[i]]
+
+    def getHops(self, i):
+        return [self.addresses[a] for a in self.hop_addr[self.hopRows(i)]]
+
+    def getLine(self, i):
+        if not self.keep_lines:
+            return None
+        (start, end) = (self.line_start[i], self.line_start[i+1])     # builds, joining self.text
+        return self.text[0][start:end]
+
+    # Build a ToD view of trace i; without the original text the line is
+    # rebuilt from the columns, with placeholders for fields not kept.
+    def trace(self, i):
+        line = self.getLine(i)
+        if line is None:
+            path = list()
+            for row in range(self.hop_start[i], self.hop_start[i+1]):
+                if self.hop_tries[row] == 0:
+                    path.append('q')
+                else:
+                    path.append(self.addresses[self.hop_addr[row]] + ',' + repr(self.hop_rtt[row]) + ',' + str(self.hop_tries[row]))
+            line = ' '.join([str(self.reqid[i]), '-', '-', '-', self.addresses[self.src[i]], self.addresses[self.dst[i]],
+                             '-', '-', str(self.ts[i]), self.dstreached[i] and 'R' or 'N', repr(self.rtt[i]), '0', '0',
+                             self.haltreason[i], '0', '-'] + path)
+        return ToD(line)
+
+    def traces(self):
+        for i in range(len(self)):
+            yield self.trace(i)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+#
+# Program:      $Id$
+# Description:  How an ArkVP reaches ToD: the tod-client program, or the bundled simulator
+
+import os
+import sys
+import select
+import subprocess
+
+
+class SubprocessTransport(object):
+    # ArkVP writes request lines with write(), waits on fileno() for answer
+    # lines, and calls clear() to drop the session's outstanding requests
+    # and close() when done. Any command that speaks tod-client's
+    # stdin/stdout line protocol and takes its arguments can be the client.
+    def __init__(self, sessionId, concurrency, client=('./tod-client',), debug=('./tod-debug',)):
+        self.sessionId = sessionId
+        self.debug = debug
+        self.process = subprocess.Popen(list(client) + ['--session-id='+sessionId,'--concurrency='+str(concurrency)],shell=False,stdin=subprocess.PIPE,stdout=subprocess.PIPE)
+
+    def write(self, data):
+        self.process.stdin.write(data)
+
+    def fileno(self):
+        return self.process.stdout.fileno()
+
+    def clear(self, timeout=30):
+        "tod-debug --clear-requests for this session; returns what it printed"
+        todDebug = subprocess.Popen(list(self.debug) + ['--session-id='+self.sessionId,'--clear-requests'],shell=False,stdout=subprocess.PIPE)
+        try:
+            fdready = select.select([todDebug.stdout], [], [], timeout)
+        except select.error:
+            return []
+        if len(fdready[0]) > 0:
+            return todDebug.stdout.readlines()
+        return []
+
+    def close(self):
+        self.process.terminate()
+
+
+class SimulatorTransport(SubprocessTransport):
+    """Runs todsim.py in place of tod-client; options are its long options, e.g. latency='constant:0.05', loss=0.01."""
+    def __init__(self, sessionId, concurrency, **options):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'todsim.py')
+        client = [sys.executable, script]
+        for (name, value) in sorted(options.iteritems()):
+            if value is True:
+                client.append('--' + name)
+            elif value is not None and value is not False:
+                client.append('--' + name + '=' + str(value))
+        SubprocessTransport.__init__(self, sessionId, concurrency, client=client)
+
+    def clear(self, timeout=30):
+        # in-band, so it is handled after the requests already written
+        try:
+            self.write('clear\n')
+        except IOError:
+            pass        # closed: nothing left to clear
+        return []
+
+
+def simulator(**options):
+    "a transport factory for ArkQueue(transport=...) that probes with todsim.py instead of ToD"
+    return lambda sessionId, concurrency: SimulatorTransport(sessionId, concurrency, **options)
@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+#
+# Program:      $Id$
+# Description:  Benchmark ArkQueue dispatch and the ToD parsing, edit distance and ASN lookup paths
+
+import getopt
+import sys
+import os
+import gc
+import json
+import time
+import random
+import socket
+import struct
+import logging
+import platform
+import tempfile
+import threading
+import SocketServer
+from arkqueue import arkqueue as aq
+from arkqueue import arkreactor
+from arkqueue import tod
+from arkqueue import bgpquery
+from arkqueue import editdistance
+from arkqueue.todsim import Simulator
+from arkqueue.tracebatch import TraceBatch
+from arkqueue.transport import simulator
+
+prog = os.path.basename(__file__)
+
+class BGPHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            fields = line.split()
+            if len(fields) < 2:
+                self.wfile.write("not found\n")
+                continue
+            self.wfile.write(self.server.answer(fields[1]))
+
+class FakeBGPDaemon(SocketServer.ThreadingTCPServer):
+    """Answers BGPquery's 's <ip>' queries on localhost: every address is in a /16 whose ASN is its second octet."""
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, port=0):
+        SocketServer.ThreadingTCPServer.__init__(self, ('localhost', port), BGPHandler)
+        self.port = self.server_address[1]
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+
+    def answer(self, ip):
+        try:
+            n = struct.unpack('!I', socket.inet_aton(ip))[0]
+        except socket.error:
+            return "not found\n"
+        return "%s/16,%d\n" % (socket.inet_ntoa(struct.pack('!I', n & 0xffff0000)), 1 + ((n >> 16) & 0xff))
+
+def rate(count, seconds):
+    return count / seconds if seconds > 0 else None
+
+def timed(func, *args):
+    gc.collect()
+    start = time.time()
+    result = func(*args)
+    return (time.time() - start, result)
+
+def histogramSummary(samples):
+    "count, mean and bucket-bound p50/p95 over every label set of one histogram from metrics_snapshot()"
+    (count, total) = (0, 0.0)
+    buckets = dict()
+    for sample in samples or []:
+        count += sample['count']
+        total += sample['sum']
+        for (le, n) in sample['buckets']:
+            buckets[le] = buckets.get(le, 0) + n
+    bounds = sorted((le for le in buckets if le != '+Inf'), key=float)
+    summary = {'count': count, 'mean': total / count if count else None}
+    for q in (50, 95):
+        summary['p%d' % q] = None
+        for le in bounds:
+            if count and buckets[le] >= count * q / 100.0:
+                summary['p%d' % q] = le
+                break
+    return summary
+
+def traceLines(count, vps=20, targets=2000, seed=1):
+    "ToD trace lines from the simulator, with repeated (vp, target) pairs as in a real campaign"
+    sim = Simulator(seed=seed)
+    rand = random.Random(seed)
+    lines = list()
+    for reqid in range(count):
+        trg = '10.%d.%d.%d' % (rand.randint(0, 255), rand.randint(0, 255), rand.randint(0, targets) % 256)
+        lines.append(sim.trace(str(reqid), 'vp%03d' % rand.randint(0, vps - 1), trg, 1500000000 + reqid))
+    return lines
+
+def benchEndToEnd(engine, vps, concurrency, probes, latency, timeout=600):
+    cls = arkreactor.ArkReactor if engine == 'reactor' else aq.ArkQueue
+    monitorfile = tempfile.NamedTemporaryFile(suffix='.txt', delete=False)
+    for i in range(vps):
+        monitorfile.write('bench%03d: 10.255.%d.%d\n' % (i, i // 250, 1 + i % 250))
+    monitorfile.close()
+    finished = [0]
+    def finish(out, request):
+        finished[0] += 1
+    ark = cls(monitorfile=monitorfile.name, yaml=False, sessionid='bench', concurrency=concurrency, timeout=timeout,
+              monitor_blacklist=list(), loggingLevel=logging.ERROR, finish_hook=finish, high_water=None,
+              transport=simulator(latency=latency, seed=1))
+    os.remove(monitorfile.name)
+    ark.start()
+    try:
+        # start every VP's simulator first, so process startup isn't counted
+        ark.addProbe([vp + ' 10.254.0.1' for vp in ark.getMonitors()])
+        deadline = time.time() + timeout
+        while finished[0] < vps and time.time() < deadline:
+            time.sleep(0.01)
+        finished[0] = 0
+        completed = ark.probes_complete()
+        monitors = ark.getMonitors()
+        targets = ['%s 10.%d.%d.%d' % (monitors[i % vps], (i >> 16) & 255, (i >> 8) & 255, i & 255) for i in range(probes)]
+        start = time.time()
+        ark.addProbe(targets)
+        queued = time.time() - start
+        deadline = start + timeout
+        while finished[0] < probes and time.time() < deadline:
+            time.sleep(0.005)
+        elapsed = time.time() - start
+        snapshot = ark.metrics_snapshot()
+        (p50, p95, p99) = ark.rtt_percentiles()
+        result = {'engine': engine, 'vps': vps, 'concurrency': concurrency, 'probes': probes, 'latency': latency,
+                  'completed': ark.probes_complete() - completed, 'delivered': finished[0],
+                  'seconds': elapsed, 'probes_per_sec': rate(finished[0], elapsed), 'enqueue_per_sec': rate(probes, queued),
+                  'stages': {'queue_wait': histogramSummary(snapshot.get('arkqueue_queue_wait_seconds')),
+                             'tod': dict(histogramSummary(snapshot.get('arkqueue_tod_seconds')), p50=p50, p95=p95, p99=p99),
+                             'callback': ark.callback_stats().get('finish_hook')}}
+    finally:
+        ark.exit()
+    return result
+
+# Both parsers are timed end to end, best of a few runs: ToD objects with
+# their hops and rtts decoded (into a fresh address table each run), against
+# a TraceBatch with its numpy hop columns built.
+def benchParse(lines, runs=3):
+    def parseToD():
+        tod.resetAddresses()
+        return timed(lambda: [tod.ToD(line) for line in lines])
+    (header, path, batch) = ([], [], [])
+    for i in range(runs):
+        (seconds, traces) = parseToD()
+        header.append(seconds)
+        path.append(timed(lambda: [(trace.hops, trace.rtts) for trace in traces])[0])
+        batch.append(timed(lambda: TraceBatch(lines).hop_ip)[0])
+    hops = sum(len(trace.hops) for trace in traces)
+    (full, header, batch) = (min(map(sum, zip(header, path))), min(header), min(batch))
+    return {'lines': len(lines),
+            'header_lines_per_sec': rate(len(lines), header),
+            'full_lines_per_sec': rate(len(lines), full),
+            'tracebatch_lines_per_sec': rate(len(lines), batch),
+            'tracebatch_speedup': full / batch if batch > 0 else None,
+            'hops_per_sec': rate(hops, full)}
+
+def benchEditDistance(lines, count):
+    traces = [tod.ToD(line) for line in lines[:count]]
+    paths = [trace.hops for trace in traces]
+    pairs = zip(paths[:-1], paths[1:])
+    (single, _) = timed(lambda: [editdistance.levenshtein(s, t) for (s, t) in pairs])
+    (bounded, _) = timed(lambda: [editdistance.levenshtein(s, t, bound=3) for (s, t) in pairs])
+    (conservative, _) = timed(lambda: [editdistance.conservative(s, t) for (s, t) in pairs])
+    m = min(len(paths), 1000)
+    (matrix, _) = timed(editdistance.distanceMatrix, paths[:m])
+    return {'ED_pairs_per_sec': rate(len(pairs), single),
+            'ED_bounded_pairs_per_sec': rate(len(pairs), bounded),
+            'ED2_pairs_per_sec': rate(len(pairs), conservative),
+            'matrix_pairs_per_sec': rate(m * (m - 1) / 2, matrix),
+            'matrix_paths': m}
+
+def benchASN(lines, count):
+    daemon = FakeBGPDaemon()
+    try:
+        traces = [tod.ToD(line) for line in lines[:count]]
+        ips = [hop for trace in traces for hop in trace.hops]
+        uncached = bgpquery.BGPclient('localhost', daemon.port, cache_size=0)
+        (raw, _) = timed(uncached.lookupMany, ips)
+        cached = bgpquery.BGPclient('localhost', daemon.port)
+        (cold, _) = timed(cached.lookupMany, ips)
+        (warm, _) = timed(cached.lookupMany, ips)
+        (hop, _) = timed(lambda: [trace.hopASN(resolver=cached) for trace in traces])
+        for client in (uncached, cached):
+            client.close()
+    finally:
+        daemon.shutdown()
+        daemon.server_close()
+    return {'lookups': len(ips),
+            'uncached_lookups_per_sec': rate(len(ips), raw),
+            'cached_cold_lookups_per_sec': rate(len(ips), cold),
+            'cached_warm_lookups_per_sec': rate(len(ips), warm),
+            'hopASN_traces_per_sec': rate(len(traces), hop)}
+
+def flatten(results, prefix=''):
+    "{'a.b.c': number} for comparing runs"
+    flat = dict()
+    if isinstance(results, dict):
+        for (key, value) in results.iteritems():
+            flat.update(flatten(value, prefix + str(key) + '.'))
+    elif isinstance(results, list):
+        for item in results:
+            if isinstance(item, dict) and 'engine' in item:
+                name = '%s.%dvp.c%d.' % (item['engine'], item['vps'], item['concurrency'])
+                flat.update(flatten(item, prefix + name))
+    elif isinstance(results, (int, long, float)) and not isinstance(results, bool):
+        flat[prefix[:-1]] = results
+    return flat
+
+def compare(old, new):
+    (old, new) = (flatten(old['results']), flatten(new['results']))
+    for key in sorted(set(old) & set(new)):
+        if key.endswith('_per_sec') and old[key]:
+            print "%-60s %12.1f %12.1f %+7.1f%%" % (key, old[key], new[key], 100.0 * (new[key] - old[key]) / old[key])
+
+def usage(prog):
+    print "Usage:", prog, "[-h] [-o results.json] [--compare=baseline.json] [--engines=thread,reactor] [--vps=10,100]"
+    print "      [--concurrency=10,50] [--probes=N] [--latency=DIST] [--lines=N] [--skip=end_to_end,parse,editdistance,asn]"
+    sys.exit(-1)
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "ho:", ["help", "output=", "compare=", "engines=", "vps=", "concurrency=", "probes=", "latency=", "lines=", "skip="])
+    except getopt.GetoptError, err:
+        usage(sys.argv[0])
+
+    (output, baseline, engines, vps, concurrency) = (None, None, ['thread', 'reactor'], [10, 100], [10, 50])
+    (probes, latency, nlines, skip) = (20000, 'lognormal:0.05,0.5', 50000, [])
+    for o, a in opts:
+        if o in ("-o", "--output"):
+            output = a
+        elif o == "--compare":
+            baseline = a
+        elif o == "--engines":
+            engines = a.split(',')
+        elif o == "--vps":
+            vps = [int(n) for n in a.split(',')]
+        elif o == "--concurrency":
+            concurrency = [int(n) for n in a.split(',')]
+        elif o == "--probes":
+            probes = int(a)
+        elif o == "--latency":
+            latency = a
+        elif o == "--lines":
+            nlines = int(a)
+        elif o == "--skip":
+            skip = a.split(',')
+        elif o in ("-h", "--help"):
+            usage(sys.argv[0])
+        else:
+            assert False, "unhandled option"
+
+    report = {'started': time.strftime('%Y-%m-%dT%H:%M:%S'), 'host': platform.node(), 'platform': platform.platform(),
+              'python': platform.python_version(), 'arguments': sys.argv[1:], 'results': dict()}
+    results = report['results']
+    lines = traceLines(nlines)
+    if 'parse' not in skip:
+        results['parse'] = benchParse(lines)
+        print '[', prog, ']', 'parse:', json.dumps(results['parse'])
+    if 'editdistance' not in skip:
+        results['editdistance'] = benchEditDistance(lines, min(nlines, 20000))
+        print '[', prog, ']', 'editdistance:', json.dumps(results['editdistance'])
+    if 'asn' not in skip:
+        results['asn'] = benchASN(lines, min(nlines, 5000))
+        print '[', prog, ']', 'asn:', json.dumps(results['asn'])
+    if 'end_to_end' not in skip:
+        results['end_to_end'] = list()
+        for engine in engines:
+            for n in vps:
+                for c in concurrency:
+                    result = benchEndToEnd(engine, n, c, probes, latency)
+                    results['end_to_end'].append(result)
+                    print '[', prog, ']', engine, n, 'VPs, concurrency', c, ':', '%.0f probes/s' % (result['probes_per_sec'] or 0), \
+                          result['delivered'], 'of', probes, 'in', '%.1f s' % result['seconds']
+
+    if output is None:
+        output = 'bench-' + time.strftime('%Y%m%d-%H%M%S') + '.json'
+    f = open(output, 'w')
+    json.dump(report, f, indent=1, sort_keys=True)
+    f.close()
+    print '[', prog, ']', 'results written to', output
+    if baseline:
+        f = open(baseline)
+        compare(json.load(f), report)
+        f.close()
+
+if __name__ == "__main__":
+    main()